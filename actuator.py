@@ -0,0 +1,168 @@
+"""actuator.py
+
+Servo moves from a dedicated thread, so that whoever asks for a move (such as
+picamera's frame callback in sweep.py) never waits on the I2C bus.
+
+Moves are queued on an Actuator, which writes them to a bus one at a time.
+Servo targets are absolute, so by default a new move supersedes any that are
+still waiting and they are dropped rather than written. Each move can carry a
+callback which is called with the angle and the time it was written once the
+write has completed.
+
+The bus is anything with a write(angle) method. I2CBus talks to the Arduino
+with smbus, which is only imported when the first angle is written, and
+FakeBus records writes without any hardware.
+"""
+
+from __future__ import division
+import time
+import threading
+import collections
+
+
+class I2CBus(object):
+    """This class writes angles to the Arduino, which moves the servo, over
+    I2C.
+
+    Since the servo's range of motion is less than 180 degrees, an angle
+    always fits in one byte.
+    """
+    def __init__(self, channel=1, address=0x04):
+        self.channel = channel
+        self.address = address
+        self.bus = None
+
+    def write(self, angle):
+        if self.bus is None:
+            import smbus
+            self.bus = smbus.SMBus(self.channel)
+        self.bus.write_byte(self.address, angle)
+
+class FakeBus(object):
+    """This class is a bus with no servo on the end. It records the angles
+    written to it and when, and can take latency seconds over each write to
+    simulate a slow bus.
+    """
+    def __init__(self, latency=0, angle=0):
+        self.latency = latency
+        self.angle = angle
+        self.writes = []
+
+    def write(self, angle):
+        if self.latency:
+            time.sleep(self.latency)
+        self.angle = angle
+        self.writes.append((time.time(), angle))
+
+class Actuator(threading.Thread):
+    """This class is a thread that writes queued servo moves to a bus.
+
+    At most maxlen moves wait in the queue; if it is full the oldest is
+    dropped. An error raised by the bus or a callback is kept and raised
+    again by the next call to move() or wait(); the move's callback isn't
+    called if the write failed.
+
+    Write times are read from clock, which replay.py replaces with the time
+    of the frame being replayed. angle is where the servo is known to be
+    before the first write, if anywhere.
+    """
+    def __init__(self, bus, maxlen=8, clock=time.time, angle=None):
+        # Set up thread. It is a daemon so that it never keeps the program
+        # alive on its own.
+        super(Actuator, self).__init__()
+        self.daemon = True
+        self.bus = bus
+        self.clock = clock
+        self.queue = collections.deque(maxlen=maxlen)
+        self.condition = threading.Condition()
+        self.busy = False
+        self.terminated = False
+        self.error = None
+
+        # Last angle written and when the write completed.
+        self.angle = angle
+        self.move_time = None
+
+        # Number of moves dropped because they were superseded, or because
+        # the queue was full.
+        self.coalesced = 0
+        self.dropped = 0
+
+        # Start thread.
+        self.start()
+
+    def move(self, angle, callback=None, coalesce=True):
+        """Queue a move to angle and return immediately. callback, if given,
+        is called from the actuator's thread as callback(angle, timestamp)
+        once the angle has been written. Unless coalesce is False, moves
+        still in the queue are dropped.
+        """
+        with self.condition:
+            self._raise()
+            if coalesce:
+                self.coalesced += len(self.queue)
+                self.queue.clear()
+            elif len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((angle, callback))
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until every queued move has been written. Return False if
+        timeout seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.queue or self.busy:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.condition.wait(remaining)
+            self._raise()
+        return True
+
+    def close(self):
+        """Write any queued moves and stop the thread."""
+        self.wait()
+        with self.condition:
+            self.terminated = True
+            self.condition.notify_all()
+        self.join()
+
+    def _raise(self):
+        # Call with the condition held.
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        # This code loops in a separate thread.
+        while True:
+            with self.condition:
+                while not self.queue and not self.terminated:
+                    self.condition.wait()
+                if self.terminated:
+                    break
+                angle, callback = self.queue.popleft()
+                self.busy = True
+
+            # Write outside the lock so that moves can still be queued while
+            # the bus is slow. Whatever goes wrong, from a missing smbus to
+            # an angle that doesn't fit in a byte or a failing callback, is
+            # kept for move() or wait() to raise, and busy is always cleared
+            # so that nobody waits on a dead thread.
+            try:
+                self.bus.write(angle)
+                self.angle = angle
+                self.move_time = self.clock()
+                if callback is not None:
+                    callback(angle, self.move_time)
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
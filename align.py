@@ -0,0 +1,125 @@
+"""align.py
+
+Register frames of a sweep to a reference frame by phase correlation, so that
+pixels can be compared across the sweep although the field of view drifts as
+the servo moves.
+
+Shifts are estimated on luma decimated depth times (see tiles.Pyramid), which
+is plenty for the few pixels of drift there are and makes the FFTs cheap. The
+reference's spectrum is computed once and the decimation and FFT buffers are
+reused for every frame. scipy.fft is used when available, as it caches FFT
+plans between calls of the same shape and can use several workers; otherwise
+numpy.fft. A whole stack can also be aligned in one batch of FFTs.
+
+Shifts are (dy, dx) in full resolution pixels, such that translate(frame, dy,
+dx) lines frame up with the reference.
+"""
+
+from __future__ import division
+
+import numpy as np
+try:
+    import scipy.fft as fft
+except ImportError:
+    import numpy.fft as fft
+
+import tiles
+
+
+def _window(shape):
+    """Return a 2D Hann window, which stops the image edges dominating the
+    correlation.
+    """
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(
+            np.float32)
+
+def _peak(correlation):
+    """Return the (dy, dx) position of the maximum of a correlation surface,
+    to sub-pixel precision by fitting a parabola either side, with shifts
+    past halfway wrapped round to negative.
+    """
+    rows, cols = correlation.shape
+    y, x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for position, size, before, centre, after in (
+            (y, rows, correlation[y - 1, x], correlation[y, x],
+                correlation[(y + 1) % rows, x]),
+            (x, cols, correlation[y, x - 1], correlation[y, x],
+                correlation[y, (x + 1) % cols])):
+        denominator = before - 2 * centre + after
+        offset = 0.5 * (before - after) / denominator if denominator else 0
+        if position > size // 2:
+            position -= size
+        shift.append(position + offset)
+    return shift
+
+class Aligner(object):
+    """This class finds the shift of frames relative to a reference frame.
+
+    frames passed in are uint8 luma of the reference's shape.
+    """
+    def __init__(self, reference, depth=2):
+        self.depth = depth
+        self.scale = 2 ** depth
+        self.pyramid = tiles.Pyramid(reference.shape, depth)
+        small = self.pyramid.build(reference)
+        self.window = _window(small.shape)
+        self.work = np.empty(small.shape, dtype=np.float32)
+        self.reference = np.conj(self._spectrum(reference))
+
+    def _spectrum(self, gray):
+        np.multiply(self.pyramid.build(gray), self.window, out=self.work)
+        return fft.rfft2(self.work)
+
+    def shift(self, gray):
+        """Return the (dy, dx) to translate gray by to line it up with the
+        reference.
+        """
+        cross = self._spectrum(gray)
+        cross *= self.reference
+        cross /= np.abs(cross) + 1e-9
+        dy, dx = _peak(fft.irfft2(cross, self.work.shape))
+        return -dy * self.scale, -dx * self.scale
+
+def translate(frame, dy, dx, out=None):
+    """Return frame moved by (dy, dx), rounded to whole pixels. Pixels moved
+    in from outside the frame repeat the nearest edge, so that no sharp
+    artificial edges are introduced.
+    """
+    dy, dx = int(round(dy)), int(round(dx))
+    if out is None:
+        out = np.empty_like(frame)
+    rows, cols = frame.shape[:2]
+    dy = max(-rows + 1, min(rows - 1, dy))
+    dx = max(-cols + 1, min(cols - 1, dx))
+
+    # Copy the part of frame which is still in view, then fill the rest from
+    # its edges.
+    top, left = max(dy, 0), max(dx, 0)
+    bottom, right = rows + min(dy, 0), cols + min(dx, 0)
+    out[top:bottom, left:right] = frame[top - dy:bottom - dy,
+                                        left - dx:right - dx]
+    out[:top, left:right] = out[top:top + 1, left:right]
+    out[bottom:, left:right] = out[bottom - 1:bottom, left:right]
+    out[:, :left] = out[:, left:left + 1]
+    out[:, right:] = out[:, right - 1:right]
+    return out
+
+def align_stack(grays, reference=0, depth=2):
+    """Return an (n, 2) array of the (dy, dx) shifts lining each of a stack
+    of uint8 luma frames up with the reference'th frame, computed in one
+    batch.
+    """
+    grays = np.asarray(grays)
+    pyramid = tiles.Pyramid(grays.shape[1:], depth)
+    small = np.empty(
+            (len(grays),) + pyramid.levels[depth].shape, dtype=np.float32)
+    for i, gray in enumerate(grays):
+        small[i] = pyramid.build(gray)
+    small *= _window(small.shape[1:])
+
+    spectra = fft.rfft2(small)
+    spectra *= np.conj(spectra[reference])
+    spectra /= np.abs(spectra) + 1e-9
+    correlations = fft.irfft2(spectra, small.shape[1:])
+    return -np.array([_peak(c) for c in correlations]) * 2 ** depth
@@ -0,0 +1,127 @@
+"""archive.py
+
+Raw archive of the frames a sweep measured, as an alternative to recording
+lossy h264 with video_sweep.py and decoding it again later.
+
+An Archive is passed to a Sweeper (or sweep.sweep(), sweep.search()...) as
+its sink. Every frame a processor measures has its Y plane copied straight
+into a preallocated memory-mapped .npy file of shape (capacity, h, w), and
+its angle, timestamp and focus measure go into a second, compact .npy index
+next to it (sweep.npy and sweep-index.npy). Nothing is compressed, so focus
+measures taken from the archive later are the same as those taken live.
+
+open_archive() maps an archive back in without copying or decoding it, as a
+(n, h, w) uint8 array of the n frames written and their index, and
+replay.py can replay it through the sweep pipeline.
+
+Usage:
+
+    archive = Archive('sweep.npy', resolution, capacity=len(angles))
+    sweep.sweep(angles, camera, resolution, sink=archive.sink)
+    archive.close()
+
+    frames, index = open_archive('sweep.npy')
+    index['angle'], index['time'], index['fm']
+
+or, to summarise an archive:
+
+    python archive.py sweep.npy
+"""
+
+from __future__ import print_function, division
+import os
+import time
+import argparse
+import threading
+
+import numpy as np
+
+
+# One entry per frame. Entries not yet written have a time of NaN.
+index_dtype = np.dtype([
+        ('angle', np.float64), ('time', np.float64), ('fm', np.float64)])
+
+def index_path(path):
+    """Return the path of the index of the archive at path."""
+    return os.path.splitext(path)[0] + '-index.npy'
+
+class Archive(object):
+    """This class writes the frames passed to its sink into a memory-mapped
+    archive of up to capacity frames of resolution (width, height).
+
+    sink() may be called from several processor threads at once. Frames
+    arriving once the archive is full are counted in dropped. Timestamps
+    are read from clock.
+    """
+    def __init__(self, path, resolution, capacity=256, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.count = 0
+        self.dropped = 0
+        self.frames = np.lib.format.open_memmap(
+                path, mode='w+', dtype=np.uint8,
+                shape=(capacity, resolution[1], resolution[0]))
+        self.index = np.lib.format.open_memmap(
+                index_path(path), mode='w+', dtype=index_dtype,
+                shape=(capacity,))
+        self.index['time'] = np.nan
+
+    def sink(self, angle, image, focus_measure):
+        """Archive a frame. Pass as Sweeper's sink argument."""
+        timestamp = self.clock()
+        with self.lock:
+            slot = self.count
+            if slot == len(self.frames):
+                self.dropped += 1
+                return
+            self.count += 1
+
+        # Copy outside the lock so that processors archive in parallel. The
+        # time goes in last, marking the entry complete.
+        np.copyto(self.frames[slot], image)
+        self.index['angle'][slot] = angle
+        self.index['fm'][slot] = focus_measure
+        self.index['time'][slot] = timestamp
+
+    def flush(self):
+        """Write everything archived so far to disk."""
+        self.frames.flush()
+        self.index.flush()
+
+    def close(self):
+        """Flush and unmap the archive."""
+        self.flush()
+        del self.frames
+        del self.index
+
+def open_archive(path):
+    """Map the archive at path and return (frames, index): the frames
+    written as a read-only (n, h, w) uint8 array and their index entries,
+    with fields angle, time and fm.
+    """
+    index = np.load(index_path(path), mmap_mode='r')
+    unused = np.flatnonzero(np.isnan(index['time']))
+    n = unused[0] if len(unused) else len(index)
+    frames = np.load(path, mmap_mode='r')
+    return frames[:n], index[:n]
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Summarise a raw sweep archive.')
+    parser.add_argument('path', help='archive .npy file')
+    args = parser.parse_args()
+
+    frames, index = open_archive(args.path)
+    print('%d frames of %dx%d' % (
+        (len(frames),) + frames.shape[2:0:-1]))
+    if len(frames):
+        best = int(np.argmax(index['fm']))
+        print('angles %g to %g over %.2f s' % (
+            index['angle'].min(), index['angle'].max(),
+            index['time'][-1] - index['time'][0]))
+        print('best focus measure %g at %g degrees (frame %d)' % (
+            index['fm'][best], index['angle'][best], best))
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,176 @@
 from __future__ import print_function
+import argparse
+
 import sweep
+import archive
+import metrics
+import focus_cache
+import make_mask
 import picamera
 
 import scipy.signal
 
-# sweep and move to max fm angle
-with picamera.PiCamera() as camera:
-    angles = range(1, 159, 1)
-    fms = sweep.sweep(angles, camera, (640, 480))
-max_angle = angles[fms.index(max(scipy.signal.medfilt(fms)))]
-sweep.move(max_angle)
-print('autofocused at %d degrees' % max_angle)
-
-# Output for Octave
-#print('angles = ', end='')
-#print(angles)
-#print('fms = ', end='')
-#print(fms)
-#print('plot(angles, fms)')
-
-#scipy.stats.medfilt(fms)
-
-print('plot(', end='')
-print(angles, end=',')
-print(fms, end=')\n')
-
-print('plot(', end='')
-print(angles, end=',')
-print(scipy.signal.medfilt(fms).tolist(), end=')\n')
+parser = argparse.ArgumentParser(
+        description='Find the angle with the maximum focus measure and move '
+        'the servo there.')
+parser.add_argument(
+        '--search', choices=['full', 'coarse', 'pyramid'], default='full',
+        help='sweep every angle, or search coarse-to-fine. pyramid measures '
+        'each level but the last at successively halved resolution '
+        '(default: full)')
+parser.add_argument(
+        '--steps', type=int, nargs='+', default=[16, 4, 1],
+        help='angle step for each level of a coarse search')
+parser.add_argument(
+        '--step', type=int, default=1,
+        help='degrees between the angles of a full sweep. Use with '
+        '--interpolate to sweep coarsely without losing accuracy '
+        '(default: 1)')
+parser.add_argument(
+        '--interpolate', choices=['parabola', 'gaussian', 'robust'],
+        help='estimate the peak of a full sweep between the angles swept by '
+        'fitting this curve around the maximum (default: take the best '
+        'angle swept)')
+parser.add_argument(
+        '--threads', type=int, default=4,
+        help='number of focus measure processors (default: 4)')
+parser.add_argument(
+        '--backend', choices=['thread', 'process'], default='thread',
+        help='run processors as threads, or hand their work to processes '
+        'which aren\'t limited by the GIL (default: thread)')
+parser.add_argument(
+        '--metric', choices=sorted(metrics.measures), default='laplace',
+        help='focus measure to maximise (default: laplace)')
+parser.add_argument(
+        '--stop-drop', type=float,
+        help='stop sweeping once the focus curve has fallen by this fraction '
+        'of its rise to a peak, e.g. 0.5 (default: sweep every angle)')
+parser.add_argument(
+        '--settle-threshold', type=float,
+        help='wait for consecutive frames to differ by less than this many '
+        'grey levels on average after each move, instead of a fixed delay')
+parser.add_argument(
+        '--stats', action='store_true',
+        help='print frame counts and processing latencies after a full '
+        'sweep')
+parser.add_argument(
+        '--sample',
+        help='ID of the sample or slot being focused. Its last focus angle '
+        'is cached, and later runs with the same ID start by searching '
+        'around it')
+parser.add_argument(
+        '--cache', default=focus_cache.path,
+        help='focus cache file (default: %(default)s)')
+parser.add_argument(
+        '--width', type=int, default=8,
+        help='degrees either side of a cached angle to search first; the '
+        'search widens if there is no peak inside (default: 8)')
+parser.add_argument(
+        '--mask', nargs='+', metavar='TOKEN',
+        help='only measure focus inside a mask given as make_mask.py '
+        'shapes in 640x480 coordinates, e.g. --mask r 0 0 640 480 0 '
+        'c 320 240 200 1')
+parser.add_argument(
+        '--archive', metavar='PATH',
+        help='also save every frame measured, uncompressed, to a raw '
+        'archive at PATH (a .npy file, see archive.py)')
+args = parser.parse_args()
+
+angles = range(1, 159, 1)
+resolution = (640, 480)
+kwargs = dict(
+        threads=args.threads, backend=args.backend, metric=args.metric,
+        stop_drop=args.stop_drop, settle_threshold=args.settle_threshold)
+
+# Compile the mask for this resolution, or fetch it from the cache
+mask_key = None
+if args.mask:
+    make_mask.load_cache()
+    spec = make_mask.parse(args.mask)
+    mask_key = make_mask.key(spec, resolution)
+    kwargs['mask'] = make_mask.compile_mask(spec, resolution)
+
+# Archive the frames measured, however many levels a search takes
+frame_archive = None
+if args.archive:
+    frame_archive = archive.Archive(
+            args.archive, resolution, capacity=2 * len(angles))
+    kwargs['sink'] = frame_archive.sink
+
+# Look up where this sample was last in focus
+cache = None
+cached = None
+if args.sample is not None:
+    cache = focus_cache.FocusCache(args.cache)
+    cached = cache.get(args.sample, resolution, mask_key)
+curve = None
+
+if cached is not None and cached['angle'] in angles:
+    # search outwards from the cached angle
+    with picamera.PiCamera() as camera:
+        max_angle, curve, moves, frames = sweep.refocus(
+                angles, camera, resolution, angles.index(cached['angle']),
+                args.width, **kwargs)
+    print('refocused at %d degrees (cached %d) using %d moves and %d frames'
+            % (max_angle, cached['angle'], moves, frames))
+elif args.search in ('coarse', 'pyramid'):
+    # search around the peak of successively finer sweeps
+    levels = None
+    if args.search == 'pyramid':
+        levels = sweep.pyramid_levels(args.steps)
+        if args.mask:
+            # one mask for each level of the pyramid
+            kwargs['mask'] = [
+                    make_mask.compile_mask(spec, (
+                        resolution[0] >> level, resolution[1] >> level))
+                    for level in range(max(levels) + 1)]
+    with picamera.PiCamera() as camera:
+        max_angle, moves, frames = sweep.search(
+                angles, camera, resolution, args.steps, levels=levels,
+                **kwargs)
+    print('autofocused at %d degrees using %d moves and %d frames' % (
+        max_angle, moves, frames))
+else:
+    # sweep and move to max fm angle
+    sweep_angles = angles[::args.step]
+    with picamera.PiCamera() as camera:
+        fms, stats = sweep.sweep(
+                sweep_angles, camera, resolution, stats=True, **kwargs)
+    if args.interpolate:
+        # the servo only takes whole degrees
+        peak, confidence = sweep.estimate_peak(
+                sweep_angles, fms, args.interpolate)
+        max_angle = int(round(peak))
+        print('peak estimated at %.2f degrees with confidence %.2f' % (
+            peak, confidence))
+    else:
+        max_angle = sweep_angles[fms.index(max(scipy.signal.medfilt(fms)))]
+    sweep.move(max_angle)
+    curve = list(zip(sweep_angles, fms))
+    print('autofocused at %d degrees' % max_angle)
+    if args.stats:
+        print(stats.report())
+
+    # Output for Octave
+    #print('angles = ', end='')
+    #print(angles)
+    #print('fms = ', end='')
+    #print(fms)
+    #print('plot(angles, fms)')
+
+    #scipy.stats.medfilt(fms)
+
+    print('plot(', end='')
+    print(sweep_angles, end=',')
+    print(fms, end=')\n')
+
+    print('plot(', end='')
+    print(sweep_angles, end=',')
+    print(scipy.signal.medfilt(fms).tolist(), end=')\n')
+
+if frame_archive is not None:
+    frame_archive.close()
+    print('archived %d frames to %s' % (frame_archive.count, args.archive))
+
+if cache is not None:
+    cache.put(args.sample, max_angle, resolution, curve, mask_key)
@@ -0,0 +1,411 @@
+"""bench_sweep.py
+
+Benchmark sweep.sweep() and sweep.Sweeper end to end without a Pi, a camera
+or an Arduino.
+
+A fake I2C bus stands in for the Arduino and models a servo which takes time
+to travel between angles. A fake camera renders synthetic YUV frames whose
+sharpness and position depend on the servo's current angle and calls
+Sweeper.write() with them at the requested framerate, just like picamera does.
+
+For each resolution we report:
+
+    ttf      time-to-focus: sweep.sweep() plus the final move, or
+             sweep.search() with --search coarse or pyramid, or
+             sweep.refocus() with --search refocus, in seconds
+    err      distance of the chosen angle from the scene's true focus angle
+    moves    servo moves made while focusing
+    fps      frames per second processed by the FocusMeasureProcessor pool
+    recv     frames received by Sweeper.write() during the sweep
+    settle   frames dropped while waiting for the servo to settle
+    busy     frames dropped because no processor was free
+    compute  time to calculate one focus measure on its own (median, ms)
+    lat      dispatch-to-result latency inside the pool (median/95th, ms)
+
+Usage:
+
+    python bench_sweep.py
+    python bench_sweep.py --resolutions 160x120 640x480 --framerate 40
+    python bench_sweep.py --search coarse --steps 16 4 1
+    python bench_sweep.py --search pyramid --resolutions 1296x972
+    python bench_sweep.py --search refocus --cached 60
+    python bench_sweep.py --backend process --threads 4
+    python bench_sweep.py --bus-latency 0.02
+
+With --scaling, frames are instead fed to the processor pool as fast as it
+will take them and the throughput of each backend is reported for each
+number of workers:
+
+    python bench_sweep.py --scaling 1 2 3 4
+"""
+
+from __future__ import print_function, division
+import sys
+import time
+import types
+import argparse
+import threading
+
+import numpy as np
+import scipy.ndimage as sn
+import scipy.signal
+
+import actuator
+
+
+class FakeServo(actuator.FakeBus):
+    """Stand-in for the I2C bus to the Arduino. Angles written to it are
+    treated as targets and the servo travels towards them at a fixed rate so
+    that frames captured mid-move show the motion.
+    """
+    def __init__(self, degpersec=200.0, angle=0, latency=0):
+        super(FakeServo, self).__init__(latency, angle)
+        self.degpersec = degpersec
+        self.lock = threading.Lock()
+        self.origin = angle
+        self.target = angle
+        self.move_time = time.time()
+
+    def write(self, angle):
+        super(FakeServo, self).write(angle)
+        with self.lock:
+            self.origin = self.position()
+            self.target = angle
+            self.move_time = time.time()
+
+    def position(self):
+        """Return the servo's current (fractional) angle."""
+        distance = self.target - self.origin
+        travelled = self.degpersec * (time.time() - self.move_time)
+        if travelled >= abs(distance):
+            return self.target
+        return self.origin + np.copysign(travelled, distance)
+
+
+class SyntheticScene(object):
+    """Textured scene which is sharpest at focus_angle and gets blurrier the
+    further the servo is from it. The field of view also drifts slightly with
+    angle, as it does on the real optics.
+
+    Blur is quantised into a fixed number of levels, each rendered once up
+    front, so producing a frame costs one copy rather than one filter.
+    """
+    def __init__(self, resolution, focus_angle=80, sigma_per_deg=0.1,
+            max_sigma=6.0, shift_per_deg=0.2, levels=16, seed=0):
+        self.resolution = resolution
+        self.focus_angle = focus_angle
+        self.sigma_per_deg = sigma_per_deg
+        self.max_sigma = max_sigma
+        self.shift_per_deg = shift_per_deg
+
+        # Pad the texture so that the field of view can drift over it.
+        w, h = resolution
+        self.margin = int(np.ceil(shift_per_deg * 180))
+        rng = np.random.RandomState(seed)
+        texture = rng.randint(0, 256, (h, w + self.margin)).astype(np.float32)
+        texture = sn.gaussian_filter(texture, 1.0)
+        self.sigmas = np.linspace(0, max_sigma, levels)
+        self.levels = [
+                np.clip(sn.gaussian_filter(texture, s), 0, 255).astype(np.uint8)
+                for s in self.sigmas]
+
+    def render(self, angle, out):
+        """Write the luma seen at the given servo angle into out."""
+        sigma = min(self.max_sigma, abs(angle - self.focus_angle)
+                * self.sigma_per_deg)
+        level = self.levels[int(np.argmin(np.abs(self.sigmas - sigma)))]
+        offset = int(round(angle * self.shift_per_deg))
+        out[...] = level[:, offset : offset + self.resolution[0]]
+
+
+class FakeCamera(object):
+    """Stand-in for picamera.PiCamera. Only the members used by sweep.py are
+    implemented. Recording calls output.write() from a separate thread with
+    one YUV420 frame per call, padded to 32x16 as picamera's are.
+    """
+    def __init__(self, servo, focus_angle=80):
+        self.servo = servo
+        self.focus_angle = focus_angle
+        self.sensor_mode = 0
+        self.resolution = (640, 480)
+        self.framerate = 30
+        self.exposure_mode = 'auto'
+        self.exposure_speed = 10000
+        self.shutter_speed = 0
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.5, 1.2)
+        self.frames = 0
+        self.scenes = {}
+        self.recording = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.recording:
+            self.stop_recording()
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def prepare(self, resolution):
+        """Render the scene for a resolution ahead of time so that it isn't
+        counted against whatever is being benchmarked.
+        """
+        resolution = tuple(resolution)
+        if resolution not in self.scenes:
+            self.scenes[resolution] = SyntheticScene(
+                    resolution, self.focus_angle)
+        return self.scenes[resolution]
+
+    def start_recording(self, output, format=None):
+        self.scene = self.prepare(self.resolution)
+        self.frames = 0
+        self.stop = threading.Event()
+        self.recording = threading.Thread(
+                target=self._record, args=(output, self.stop))
+        self.recording.start()
+
+    def wait_recording(self, timeout=0):
+        time.sleep(timeout)
+
+    def stop_recording(self):
+        self.stop.set()
+        self.recording.join()
+        self.recording = None
+
+    def _record(self, output, stop):
+        w, h = self.resolution
+        fw = (w + 31) // 32 * 32
+        fh = (h + 15) // 16 * 16
+        buf = bytearray(fw * fh * 3 // 2)
+        frame = np.frombuffer(buf, dtype=np.uint8)
+        frame[fw * fh:] = 128 # neutral chroma
+        luma = frame[:fw * fh].reshape(fh, fw)[:h, :w]
+
+        interval = 1.0 / self.framerate
+        next_frame = time.time()
+        while not stop.is_set():
+            # Like the real camera, drop frames rather than fall behind.
+            now = time.time()
+            if now < next_frame:
+                time.sleep(next_frame - now)
+            next_frame = max(next_frame + interval, time.time())
+
+            self.scene.render(self.servo.position(), luma)
+            output.write(bytes(buf))
+            self.frames += 1
+        output.flush()
+
+
+# sweep.py imports picamera, so the fake must be installed in its place
+# first. The servo's bus can simply be swapped afterwards.
+servo = FakeServo()
+picamera = types.ModuleType('picamera')
+picamera.PiCamera = lambda: FakeCamera(servo)
+sys.modules.setdefault('picamera', picamera)
+
+import sweep
+import metrics
+sweep.servo = actuator.Actuator(servo, angle=servo.angle)
+sweep.calibration_time = 0 # nothing to calibrate
+
+
+def time_to_focus(camera, angles, resolution, framerate, search, steps,
+        cached=None, **kwargs):
+    """Autofocus the way autofocus.py does and return (seconds, angle,
+    moves). With search='refocus', start from the cached angle as
+    autofocus.py --sample does.
+    """
+    start = time.time()
+    if search == 'coarse':
+        max_angle, moves, _ = sweep.search(
+                angles, camera, resolution, steps, framerate, **kwargs)
+    elif search == 'refocus':
+        max_angle, _, moves, _ = sweep.refocus(
+                angles, camera, resolution, angles.index(cached),
+                framerate=framerate, **kwargs)
+    elif search == 'pyramid':
+        max_angle, moves, _ = sweep.search(
+                angles, camera, resolution, steps, framerate,
+                sweep.pyramid_levels(steps), **kwargs)
+    else:
+        fms = sweep.sweep(angles, camera, resolution, framerate, **kwargs)
+        max_angle = angles[fms.index(max(scipy.signal.medfilt(fms)))]
+        sweep.move(max_angle)
+        moves = len(fms) + 1
+    return time.time() - start, max_angle, moves
+
+
+def throughput(camera, angles, resolution, framerate, **kwargs):
+    """Run one sweep and return the sweeper and its duration. The sweeper's
+    stats say where the time went.
+    """
+    previous = sweep.origin(angles[0])
+    sweep.move(angles[0])
+    camera.resolution = resolution
+    camera.framerate = framerate
+    sweeper = sweep.Sweeper(angles, resolution, start=previous, **kwargs)
+    start = time.time()
+    camera.start_recording(sweeper, 'yuv')
+    while time.time() - start < sweep.timeout and not sweeper.done:
+        camera.wait_recording(1.0 / framerate)
+    elapsed = time.time() - start
+    camera.stop_recording()
+    return sweeper, elapsed
+
+
+def saturate(scene, frames, **kwargs):
+    """Feed frames to a Sweeper as fast as it will take them, with no servo
+    delay, and return the number of frames processed per second. This is
+    the most the processor pool can do regardless of camera framerate.
+
+    The sweep never moves, so the actuator is bypassed altogether: waiting
+    on its thread for every frame would measure the round trip to it
+    rather than the pool.
+    """
+    w, h = scene.resolution
+    fw = (w + 31) // 32 * 32
+    fh = (h + 15) // 16 * 16
+    buf = bytearray(fw * fh * 3 // 2)
+    luma = np.frombuffer(buf, dtype=np.uint8)[:fw * fh].reshape(fh, fw)
+    scene.render(scene.focus_angle, luma[:h, :w])
+    buf = bytes(buf)
+
+    secperdeg = sweep.secperdeg
+    sweep.secperdeg = 0
+    sweeper = sweep.Sweeper([scene.focus_angle] * frames, (w, h), **kwargs)
+    sweeper.move_to = lambda angle_index, degrees: None
+    start = time.time()
+    while None in sweeper.focus_measures:
+        sweeper.write(buf)
+        if sweeper.processor is None:
+            time.sleep(0.0005) # pool busy, don't hog the GIL
+    elapsed = time.time() - start
+    sweeper.flush()
+    sweep.secperdeg = secperdeg
+    return frames / elapsed
+
+
+def scaling(camera, resolutions, workers, metric, frames=100):
+    """Print how saturated pool throughput scales with the number of workers
+    for each backend.
+    """
+    print('saturated fps for %d frames' % frames)
+    print('%-10s %-8s' % ('res', 'backend')
+            + ''.join(['%8s' % ('x%d' % n) for n in workers]))
+    for resolution in resolutions:
+        scene = camera.prepare(resolution)
+        for backend in ['thread', 'process']:
+            print('%-10s %-8s' % ('%dx%d' % resolution, backend)
+                    + ''.join([
+                        '%8.1f' % saturate(
+                            scene, frames, threads=n, backend=backend,
+                            metric=metric)
+                        for n in workers]))
+
+
+def compute_time(resolution, metric, repeat=20):
+    """Median time for the focus measure calculation alone, in seconds."""
+    w, h = resolution
+    scene = SyntheticScene(resolution)
+    image = np.empty((h, w), dtype=np.uint8)
+    scene.render(scene.focus_angle, image)
+    focus_measure = metrics.get(metric)
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        focus_measure(image)
+        times.append(time.time() - start)
+    return np.median(times)
+
+
+def parse_resolution(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the sweep pipeline with fake hardware.')
+    parser.add_argument('--resolutions', nargs='+', type=parse_resolution,
+            default=[(160, 120), (320, 240), (640, 480), (1296, 972)],
+            metavar='WxH')
+    parser.add_argument('--angles', nargs=3, type=int, default=[1, 159, 1],
+            metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('--framerate', type=float, default=30)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--backend', choices=['thread', 'process'],
+            default='thread', help='Sweeper processor backend')
+    parser.add_argument('--metric', choices=sorted(metrics.measures),
+            default='laplace', help='focus measure to use')
+    parser.add_argument('--stop-drop', type=float,
+            help='stop sweeps early once the curve falls by this fraction '
+            'of its rise to a peak')
+    parser.add_argument('--settle-threshold', type=float,
+            help='detect servo settling from frame differences with this '
+            'threshold instead of a fixed delay')
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='N',
+            help='instead, report saturated pool throughput for each '
+            'backend with each of these worker counts')
+    parser.add_argument('--focus', type=int, default=80,
+            help='angle at which the synthetic scene is sharpest')
+    parser.add_argument('--search',
+            choices=['full', 'coarse', 'pyramid', 'refocus'],
+            default='full', help='autofocus strategy to time')
+    parser.add_argument('--cached', type=int, default=85,
+            help='angle a refocus search starts from')
+    parser.add_argument('--steps', type=int, nargs='+', default=[16, 4, 1],
+            help='angle step for each level of a coarse search')
+    parser.add_argument('--bus-latency', type=float, default=0,
+            help='seconds each write to the fake I2C bus takes')
+    args = parser.parse_args()
+    servo.latency = args.bus_latency
+
+    angles = list(range(*args.angles))
+    camera = FakeCamera(servo, args.focus)
+    if args.scaling:
+        scaling(camera, args.resolutions, args.scaling, args.metric)
+        return
+
+    print('%d angles at %g fps, %d %s processors, %s' % (
+        len(angles), args.framerate, args.threads, args.backend,
+        args.metric))
+    print('%-10s %7s %5s %5s %7s %6s %6s %6s %8s %13s' % (
+        'res', 'ttf s', 'err', 'moves', 'fps', 'recv', 'settle', 'busy',
+        'compute', 'lat p50/p95'))
+    for resolution in args.resolutions:
+        camera.prepare(resolution)
+        ttf, angle, moves = time_to_focus(
+                camera, angles, resolution, args.framerate,
+                args.search, args.steps, args.cached,
+                threads=args.threads, backend=args.backend,
+                metric=args.metric, stop_drop=args.stop_drop,
+                settle_threshold=args.settle_threshold)
+        sweeper, elapsed = throughput(
+                camera, angles, resolution, args.framerate,
+                threads=args.threads, backend=args.backend,
+                metric=args.metric, stop_drop=args.stop_drop,
+                settle_threshold=args.settle_threshold)
+        processed = len([
+            fm for fm in sweeper.focus_measures if fm is not None])
+        stats = sweeper.stats
+        latencies = stats.latencies()
+        print('%-10s %7.2f %5d %5d %7.1f %6d %6d %6d %8.2f %6.2f/%6.2f' % (
+            '%dx%d' % resolution,
+            ttf,
+            angle - args.focus,
+            moves,
+            processed / elapsed,
+            stats.received,
+            stats.skipped_settle,
+            stats.skipped_busy,
+            compute_time(resolution, args.metric) * 1000,
+            np.percentile(latencies, 50) * 1000,
+            np.percentile(latencies, 95) * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""focal_stack.py
+
+Combine a focal stack into a single image which is in focus everywhere, by
+taking each pixel from whichever slice of the stack is sharpest there.
+
+Slices are streamed in one at a time, from a recorded sweep video or live
+from a Sweeper through its sink hook, and only the running best sharpness,
+the composite and the index of the slice each pixel came from are kept. Memory
+use is therefore a few frames' worth however many slices there are.
+
+Local sharpness is the mean squared laplacian over a square window around
+each pixel. With threads > 1 the frame is split into horizontal bands which
+are processed in parallel, each with enough overlap (halo) that the result is
+the same as processing the frame whole.
+
+The field of view drifts as the servo moves, so slices can be registered to
+the first one with align.Aligner before they are compared.
+
+Usage:
+
+    python focal_stack.py sweep.h264 -o stacked.png --depth depth.png --align
+
+or, during a sweep:
+
+    stacker = focal_stack.FocalStacker()
+    sweep.sweep(angles, camera, resolution, sink=stacker.sink)
+    stacker.composite
+"""
+
+from __future__ import print_function, division
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.ndimage as sn
+
+import align
+import metrics
+
+
+def to_gray(frame):
+    """Return the luma of a BGR frame (as cv2 reads them) as uint8, or the
+    frame itself if it is already grayscale.
+    """
+    if frame.ndim == 2:
+        return frame
+    # Integer approximation of 0.114 B + 0.587 G + 0.299 R
+    gray = np.multiply(frame[..., 0], 29, dtype=np.uint16)
+    gray += np.multiply(frame[..., 1], 150, dtype=np.uint16)
+    gray += np.multiply(frame[..., 2], 77, dtype=np.uint16)
+    gray >>= 8
+    return gray.astype(np.uint8)
+
+def local_sharpness(gray, window=9, out=None):
+    """Return the mean squared laplacian over a window x window square
+    around each pixel of a uint8 image, as float32.
+    """
+    lap = metrics.laplacian(gray)
+    energy = np.multiply(lap, lap, dtype=np.float32)
+    if out is None:
+        out = np.empty(gray.shape, dtype=np.float32)
+    sn.uniform_filter(energy, window, output=out, mode='nearest')
+    return out
+
+class FocalStacker(object):
+    """This class builds an all-in-focus composite from slices added one at a
+    time.
+
+    composite holds the best pixels so far, sharpness their local sharpness
+    and depth the index of the slice each came from (the angle, when fed by
+    a Sweeper). Arrays are allocated when the first slice arrives.
+    add() and sink() may be called from several threads at once.
+
+    If align_depth is given, each slice is first translated to line up with
+    the first, its shift being estimated on luma decimated align_depth
+    times. shifts records the shift applied to each slice.
+    """
+    def __init__(self, window=9, threads=1, align_depth=None):
+        self.window = window
+        self.threads = threads
+        self.align_depth = align_depth
+        self.aligner = None
+        self.shifts = []
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.lock = threading.Lock()
+        self.composite = None
+        self.sharpness = None
+        self.depth = None
+        self.count = 0
+
+    def _allocate(self, frame):
+        self.composite = np.zeros_like(frame)
+        self.sharpness = np.full(frame.shape[:2], -1, dtype=np.float32)
+        self.depth = np.zeros(frame.shape[:2], dtype=np.int32)
+
+        # Split the rows into one band per thread. Each band is processed
+        # with halo extra rows either side: one for the laplacian and the
+        # rest for the window.
+        rows = frame.shape[0]
+        edges = np.linspace(0, rows, self.threads + 1).astype(int)
+        halo = self.window // 2 + 1
+        self.bands = [
+                (top, bottom, max(0, top - halo), min(rows, bottom + halo))
+                for top, bottom in zip(edges[:-1], edges[1:])
+                if bottom > top]
+
+    def _update_band(self, band, frame, gray, index):
+        top, bottom, lo, hi = band
+        sharp = local_sharpness(gray[lo:hi], self.window)[top - lo:bottom - lo]
+        better = sharp > self.sharpness[top:bottom]
+        np.copyto(self.sharpness[top:bottom], sharp, where=better)
+        np.copyto(self.depth[top:bottom], index, where=better)
+        if frame.ndim == 3:
+            better = better[..., np.newaxis]
+        np.copyto(self.composite[top:bottom], frame[top:bottom], where=better)
+
+    def add(self, frame, index=None, gray=None):
+        """Add a slice. frame may be grayscale or BGR; gray is its luma if
+        already known. index labels the slice in the depth map and defaults
+        to the number of slices added so far.
+        """
+        if gray is None:
+            gray = to_gray(frame)
+        with self.lock:
+            if self.composite is None:
+                self._allocate(frame)
+                if self.align_depth is not None:
+                    self.aligner = align.Aligner(gray, self.align_depth)
+            if self.aligner is not None:
+                shift = self.aligner.shift(gray)
+                frame = align.translate(frame, *shift)
+                gray = align.translate(gray, *shift)
+                self.shifts.append(shift)
+            if index is None:
+                index = self.count
+            if self.pool is None:
+                for band in self.bands:
+                    self._update_band(band, frame, gray, index)
+            else:
+                self.pool.map(
+                        lambda band: self._update_band(
+                            band, frame, gray, index),
+                        self.bands)
+            self.count += 1
+
+    def sink(self, angle, image, focus_measure):
+        """Add a slice from a Sweeper. Pass as Sweeper's sink argument."""
+        self.add(image, angle)
+
+    def close(self):
+        """Stop the worker threads, if any."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def stack_video(path, stacker, step=1):
+    """Feed every step-th frame of the video at path to stacker. Return the
+    number of frames added.
+    """
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    frame_num = 0
+    while True:
+        flag, frame = cap.read()
+        if not flag: # end of video
+            break
+        if frame_num % step == 0:
+            stacker.add(frame, frame_num)
+            print("stacking frame {:d}".format(frame_num), end='\r')
+        frame_num += 1
+    cap.release()
+    print()
+    return stacker.count
+
+def main():
+    import cv2
+
+    parser = argparse.ArgumentParser(
+            description='Stack the frames of a focus sweep video into one '
+            'image which is in focus everywhere.')
+    parser.add_argument('path', help='video of the sweep')
+    parser.add_argument(
+            '-o', '--output', default='stacked.png',
+            help='composite image to write (default: stacked.png)')
+    parser.add_argument(
+            '--depth',
+            help='also write the frame each pixel came from to this image, '
+            'scaled to 0-255')
+    parser.add_argument(
+            '--window', type=int, default=9,
+            help='size of the square window sharpness is measured over '
+            '(default: 9)')
+    parser.add_argument(
+            '--step', type=int, default=1,
+            help='only stack every nth frame (default: 1)')
+    parser.add_argument(
+            '--threads', type=int, default=1,
+            help='number of bands to process in parallel (default: 1)')
+    parser.add_argument(
+            '--align', type=int, nargs='?', const=2, metavar='DEPTH',
+            help='line frames up with the first before stacking, estimating '
+            'shifts at 1/2^DEPTH resolution (default DEPTH: 2)')
+    args = parser.parse_args()
+
+    stacker = FocalStacker(args.window, args.threads, args.align)
+    count = stack_video(args.path, stacker, args.step)
+    stacker.close()
+    if count == 0:
+        parser.error('no frames could be read from %s' % args.path)
+
+    cv2.imwrite(args.output, stacker.composite)
+    if args.depth:
+        depth = stacker.depth * (255 / max(1, stacker.depth.max()))
+        cv2.imwrite(args.depth, depth.astype(np.uint8))
+    print("stacked %d frames into %s" % (count, args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""focus_cache.py
+
+On-disk cache of recent autofocus results, keyed by a sample (or slot) ID, so
+that refocusing on a sample can start near the angle it was last in focus at.
+
+Each entry records the angle focused at, the focus curve if there is one,
+the resolution, a hash of the mask used and when it was stored. A result is
+only reused if it was found at the same resolution with the same mask. The
+cache holds at most capacity entries, evicting the least recently used.
+
+The cache is a single JSON file which is rewritten atomically (written to a
+temporary file, then renamed over the old one), so that a run interrupted
+mid-write can't corrupt it.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+# Default location, next to this file
+path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'focus_cache.json')
+capacity = 64
+
+def mask_hash(mask):
+    """Return a short hash identifying a boolean mask, or None for no mask."""
+    if mask is None:
+        return None
+    mask = np.asarray(mask, dtype=bool)
+    digest = hashlib.sha1(str(mask.shape).encode('ascii'))
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()[:16]
+
+class FocusCache(object):
+    """This class is an LRU cache of focus results stored in a JSON file.
+
+    Entries are dicts with keys angle, curve (a list of [angle, focus
+    measure] pairs, or None), resolution, mask, time (when the result was
+    found) and used (when the entry was last stored or looked up).
+    """
+    def __init__(self, path=path, capacity=capacity):
+        self.path = path
+        self.capacity = capacity
+        self.entries = self.load()
+
+    def load(self):
+        """Read the entries from disk. A missing or unreadable file gives an
+        empty cache.
+        """
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def save(self):
+        """Write the entries to disk atomically."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(
+                prefix='.focus_cache', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, self.path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def get(self, sample, resolution, mask=None):
+        """Return the entry for sample if it was found at this resolution
+        with this mask (a boolean array or its mask_hash), otherwise None.
+        """
+        entry = self.entries.get(str(sample))
+        if entry is None:
+            return None
+        if not isinstance(mask, (str, type(None))):
+            mask = mask_hash(mask)
+        if list(entry['resolution']) != list(resolution) \
+                or entry['mask'] != mask:
+            return None
+        entry['used'] = time.time()
+        return entry
+
+    def put(self, sample, angle, resolution, curve=None, mask=None):
+        """Store a result for sample, evict the least recently used entries
+        beyond capacity and save.
+        """
+        if not isinstance(mask, (str, type(None))):
+            mask = mask_hash(mask)
+        if curve is not None:
+            curve = [[int(a), float(fm)] for a, fm in curve]
+        now = time.time()
+        self.entries[str(sample)] = {
+                'angle': int(angle),
+                'curve': curve,
+                'resolution': list(resolution),
+                'mask': mask,
+                'time': now,
+                'used': now}
+        while len(self.entries) > self.capacity:
+            oldest = min(
+                    self.entries, key=lambda key: self.entries[key]['used'])
+            del self.entries[oldest]
+        self.save()
@@ -5,13 +5,30 @@ arguments and saves it as an image file.
 
 The intention is for this mask to be applied to captured images to ignore
 certain areas of the image.
+
+A mask is specified by a list of shapes drawn in order onto a blank (all 1s)
+mask, in 640x480 coordinates:
+
+    c a b r val         circle with centre (a, b) and radius r
+    r a b w h val       rectangle with top-left corner (a, b), width w and
+                        height h
+
+e.g. python make_mask.py r 0 0 640 480 0 c 320 240 200 1
+
+The same spec can be compiled into a metrics.Roi for any capture resolution,
+with coordinates scaled to fit, using compile_mask(). Compiled masks are
+cached in memory and as .npz files in cache_directory, keyed by the spec and
+resolution, so that a sweep at any resolution gets its mask without
+rendering or scanning a bool array more than once.
 """
 
+import os
 import sys
-import ConfigParser
+import hashlib
 
 import numpy as np
-import scipy.misc
+
+import metrics
 
 
 # Default save path for the image
@@ -23,9 +40,14 @@ filename = 'mask'
 # Default file format extension for the image
 extension = '.png'
 
-# Default resolution
+# Default resolution. Specs are written in these coordinates.
 resolution = (640, 480)
 
+# Compiled masks, in memory and on disk
+cache_directory = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'mask_cache')
+compiled = {}
+
 
 def draw_circle(array, a, b, r, val):
     """Draw a circle on array with centre (a, b) and radius r, filled with a
@@ -62,30 +84,82 @@ def draw_rectangle(array, a, b, w, h, val):
     # otherwise.
     array[b : b + h, a : a + w] = val != 0
 
-
-# Start off with a blank mask (all 1s so that image is entirely unmasked)
-mask = np.ones(resolution[::-1], dtype=bool) # [::-1] reads tuple backwards
-
-# Parse command-line arguments
-for i, arg in enumerate(sys.argv):
-    if arg == 'c':
-        draw_circle(
-                mask,
-                int(sys.argv[i+1]),
-                int(sys.argv[i+2]),
-                int(sys.argv[i+3]),
-                int(sys.argv[i+4]))
-    elif arg == 'r':
-        draw_rectangle(
-                mask,
-                int(sys.argv[i+1]),
-                int(sys.argv[i+2]),
-                int(sys.argv[i+3]),
-                int(sys.argv[i+4]),
-                int(sys.argv[i+5]))
-
-# Save completed mask
-scipy.misc.imsave("".join([path, filename, extension]), mask)
-
-# For a viewable preview we want 1s to be whites (255) and 0s to be blacks (0)?
-#scipy.misc.imsave("".join([path, filename, "-preview", extension]), mask * 255)
+def parse(args):
+    """Return the shapes in a list of command-line style tokens as a spec:
+    a tuple of ('c', a, b, r, val) and ('r', a, b, w, h, val) tuples.
+    """
+    spec = []
+    for i, arg in enumerate(args):
+        if arg == 'c':
+            spec.append(('c',) + tuple(int(n) for n in args[i+1:i+5]))
+        elif arg == 'r':
+            spec.append(('r',) + tuple(int(n) for n in args[i+1:i+6]))
+    return tuple(spec)
+
+def render(spec, size=resolution):
+    """Draw spec onto a blank mask of size (width, height), scaling its
+    coordinates from resolution.
+    """
+    sx = size[0] / float(resolution[0])
+    sy = size[1] / float(resolution[1])
+    mask = np.ones(size[::-1], dtype=bool) # [::-1] reads tuple backwards
+    for shape in spec:
+        if shape[0] == 'c':
+            a, b, r, val = shape[1:]
+            draw_circle(
+                    mask, int(round(a * sx)), int(round(b * sy)),
+                    r * (sx + sy) / 2, val)
+        else:
+            a, b, w, h, val = shape[1:]
+            draw_rectangle(
+                    mask, int(round(a * sx)), int(round(b * sy)),
+                    int(round(w * sx)), int(round(h * sy)), val)
+    return mask
+
+def key(spec, size):
+    """Return the cache key for spec compiled at size."""
+    return hashlib.sha1(repr((tuple(spec), tuple(size))).encode(
+        'ascii')).hexdigest()[:16]
+
+def compile_mask(spec, size):
+    """Return spec compiled into a metrics.Roi for frames of size (width,
+    height), from the cache if possible.
+    """
+    k = key(spec, size)
+    if k in compiled:
+        return compiled[k]
+    cached = os.path.join(cache_directory, 'mask-%s.npz' % k)
+    if os.path.exists(cached):
+        with np.load(cached) as arrays:
+            roi = metrics.Roi.unpack(arrays)
+    else:
+        roi = metrics.Roi(render(spec, size))
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        np.savez(cached, **roi.pack())
+    compiled[k] = roi
+    return roi
+
+def load_cache():
+    """Load every compiled mask on disk into memory."""
+    if not os.path.isdir(cache_directory):
+        return
+    for name in os.listdir(cache_directory):
+        if name.startswith('mask-') and name.endswith('.npz'):
+            with np.load(os.path.join(cache_directory, name)) as arrays:
+                compiled[name[5:-4]] = metrics.Roi.unpack(arrays)
+
+def main():
+    from PIL import Image
+
+    # Start off with a blank mask (all 1s so that image is entirely unmasked)
+    # and draw the shapes given by the command-line arguments
+    mask = render(parse(sys.argv[1:]))
+
+    # Save completed mask. For a viewable image 1s are whites (255) and 0s
+    # are blacks (0).
+    Image.fromarray(mask.astype(np.uint8) * 255).save(
+            "".join([path, filename, extension]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""metrics.py
+
+Library of focus measures which can be selected by name.
+
+Every focus measure takes a 2D uint8 luma image and an optional mask, and
+returns a single number which is larger the better focused the image is.
+Kernels are evaluated with int16/int32 arithmetic directly on the uint8 image
+so that no float image is ever allocated. The one pixel border, where the
+kernels are undefined, is ignored.
+
+The mask can be a boolean array the same shape as the image, but when the
+same mask is used for many frames it should be compiled into a Roi once.
+Kernels are then only evaluated over the mask's bounding box and the pixels
+under the mask are gathered from a precomputed index.
+
+New focus measures can be added with the register decorator:
+
+    @metrics.register('my_measure')
+    def my_measure(image, mask=None):
+        ...
+"""
+
+from __future__ import division
+
+import numpy as np
+
+
+# Registry of focus measures by name
+measures = {}
+
+def register(name):
+    """Decorator which adds a focus measure to the registry under name."""
+    def decorator(function):
+        measures[name] = function
+        return function
+    return decorator
+
+def get(name):
+    """Look up a focus measure by name."""
+    try:
+        return measures[name]
+    except KeyError:
+        raise ValueError('unknown focus measure %r, expected one of %s' % (
+            name, ', '.join(sorted(measures))))
+
+def _interior(array):
+    """Return the part of array which excludes its one pixel border."""
+    return array[1:-1, 1:-1]
+
+class Roi(object):
+    """This class is a region of interest compiled from a boolean mask for
+    one resolution.
+
+    window slices the part of the image needed to evaluate a 3x3 kernel over
+    the mask's bounding box (less the image's border). index holds the flat
+    positions of the masked pixels within that bounding box, or is None if
+    the bounding box is entirely masked in.
+    """
+    def __init__(self, mask):
+        self.shape = mask.shape
+
+        # Pixels on the border never contribute.
+        interior = _interior(mask)
+        rows = np.flatnonzero(interior.any(axis=1))
+        cols = np.flatnonzero(interior.any(axis=0))
+        if len(rows) == 0:
+            raise ValueError('mask is empty')
+
+        # Bounding box in interior coordinates, grown by one pixel each way
+        # to get the window in image coordinates.
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = cols[0], cols[-1] + 1
+        self.window = (slice(top, bottom + 2), slice(left, right + 2))
+
+        box = interior[top:bottom, left:right]
+        self.size = int(np.count_nonzero(box))
+        if self.size == box.size:
+            self.index = None
+        else:
+            self.index = np.flatnonzero(box)
+
+    def pack(self):
+        """Return the Roi as a dict of arrays which can be saved with
+        np.savez and turned back into a Roi with Roi.unpack.
+        """
+        index = self.index
+        if index is None:
+            index = np.empty(0, dtype=np.intp) # a Roi is never empty
+        return {
+                'shape': np.array(self.shape),
+                'window': np.array([[s.start, s.stop] for s in self.window]),
+                'size': np.array(self.size),
+                'index': index}
+
+    @classmethod
+    def unpack(cls, arrays):
+        """Return the Roi packed into arrays by pack."""
+        roi = cls.__new__(cls)
+        roi.shape = tuple(int(n) for n in arrays['shape'])
+        roi.window = tuple(
+                slice(int(start), int(stop))
+                for start, stop in arrays['window'])
+        roi.size = int(arrays['size'])
+        roi.index = np.asarray(arrays['index'])
+        if len(roi.index) == 0:
+            roi.index = None
+        return roi
+
+    def select(self, values):
+        """Return the masked values from an array covering the bounding
+        box.
+        """
+        if self.index is None:
+            return values
+        return np.take(values.ravel(), self.index)
+
+def _roi(image, mask):
+    """Return the part of image to evaluate kernels over and the Roi, if any,
+    to select values from the result with.
+    """
+    if mask is None:
+        return image, None
+    if not isinstance(mask, Roi):
+        mask = Roi(mask)
+    return image[mask.window], mask
+
+def _select(values, roi):
+    """Return the values selected by roi, or all of them if there is no
+    roi.
+    """
+    if roi is None:
+        return values
+    return roi.select(values)
+
+def _sum_squares(values):
+    """Sum the squares of an integer array without overflowing or allocating
+    a squared copy.
+    """
+    subscripts = 'ij,ij->' if values.ndim == 2 else 'i,i->'
+    return int(np.einsum(subscripts, values, values, dtype=np.int64))
+
+def _laplacian(image, out):
+    """Write the 4-neighbour laplacian of image's interior into out, an int16
+    array of shape (h-2, w-2).
+    """
+    out[...] = _interior(image)
+    out *= -4
+    out += image[:-2, 1:-1]
+    out += image[2:, 1:-1]
+    out += image[1:-1, :-2]
+    out += image[1:-1, 2:]
+    return out
+
+def laplacian(image):
+    """Return the laplacian of a uint8 image as int16, with the border set
+    to 0.
+    """
+    out = np.zeros(image.shape, dtype=np.int16)
+    _laplacian(image, _interior(out))
+    return out
+
+def _sobel(image):
+    """Return the horizontal and vertical Sobel gradients of image's
+    interior as int16 arrays of shape (h-2, w-2).
+    """
+    shape = (image.shape[0] - 2, image.shape[1] - 2)
+
+    # Horizontal gradient: right column minus left column, weighted 1-2-1
+    # down the rows.
+    gx = np.empty(shape, dtype=np.int16)
+    gx[...] = image[1:-1, 2:]
+    gx -= image[1:-1, :-2]
+    gx *= 2
+    gx += image[:-2, 2:]
+    gx -= image[:-2, :-2]
+    gx += image[2:, 2:]
+    gx -= image[2:, :-2]
+
+    # Vertical gradient: bottom row minus top row, weighted 1-2-1 across the
+    # columns.
+    gy = np.empty(shape, dtype=np.int16)
+    gy[...] = image[2:, 1:-1]
+    gy -= image[:-2, 1:-1]
+    gy *= 2
+    gy += image[2:, :-2]
+    gy -= image[:-2, :-2]
+    gy += image[2:, 2:]
+    gy -= image[:-2, 2:]
+    return gx, gy
+
+@register('laplace')
+def mean_abs_laplacian(image, mask=None):
+    """Mean absolute value of the laplacian."""
+    image, roi = _roi(image, mask)
+    lap = _laplacian(image, np.empty(
+        (image.shape[0] - 2, image.shape[1] - 2), dtype=np.int16))
+    values = _select(np.abs(lap, out=lap), roi)
+    return np.sum(values, dtype=np.int64) / values.size
+
+@register('laplace_var')
+def laplacian_variance(image, mask=None):
+    """Variance of the laplacian."""
+    image, roi = _roi(image, mask)
+    lap = _laplacian(image, np.empty(
+        (image.shape[0] - 2, image.shape[1] - 2), dtype=np.int16))
+    values = _select(lap, roi)
+    mean = np.sum(values, dtype=np.int64) / values.size
+    return _sum_squares(values) / values.size - mean * mean
+
+@register('tenengrad')
+def tenengrad(image, mask=None):
+    """Mean squared magnitude of the Sobel gradient."""
+    image, roi = _roi(image, mask)
+    gx, gy = _sobel(image)
+    gx = _select(gx, roi)
+    gy = _select(gy, roi)
+    return (_sum_squares(gx) + _sum_squares(gy)) / gx.size
+
+@register('brenner')
+def brenner(image, mask=None):
+    """Mean squared difference between pixels two columns apart."""
+    image, roi = _roi(image, mask)
+    diff = np.empty(
+            (image.shape[0] - 2, image.shape[1] - 2), dtype=np.int16)
+    diff[...] = image[1:-1, 2:]
+    diff -= image[1:-1, :-2]
+    values = _select(diff, roi)
+    return _sum_squares(values) / values.size
+
+@register('normalised_variance')
+def normalised_variance(image, mask=None):
+    """Variance of the pixel intensities divided by their mean, so that the
+    measure doesn't depend on brightness.
+    """
+    image, roi = _roi(image, mask)
+    values = _select(_interior(image), roi)
+    mean = np.sum(values, dtype=np.int64) / values.size
+    if mean == 0:
+        return 0.0
+    return (_sum_squares(values) / values.size - mean * mean) / mean
@@ -1,8 +1,8 @@
 """averager.py
 
-Copied from 
+Originally copied from
 https://stackoverflow.com/questions/17291455/how-to-get-an-average-picture-from-100-pictures-using-pil
-Adapted slightly to easily change directory and extension.
+and since rewritten to cope with hundreds of frames from a sweep.
 
 This script will read all files from the specified directory which have names
 ending with any of the strings specified in the list 'extensions'. Then it
@@ -14,63 +14,186 @@ arguments:
     python averager.py [directory] [extension1] [extension2] ...
 
     python averager.py /home/pi/images/ .png .PNG .jpg .JPG
-
-NOTE: code assums that extensions are 4 characters long and images are RGB.
+    python averager.py /home/pi/images/ .png --method sigma --sigma 2.5
+
+Images are decoded by a pool of threads. The mean is accumulated in place in a
+preallocated running sum (uint32 for 8 and 16 bit images, float32 otherwise),
+so nothing but the decoded image is allocated per image. Images may be any
+PIL mode (palette images are converted to RGB) but must all be the same size
+and mode.
+
+The median, and the sigma-clipped mean which leaves out outliers such as
+passing debris, need every image at once. Images are then decoded into a
+memory-mapped volume on disk and reduced a band of rows at a time, so memory
+use is bounded by --chunk rather than the number of images.
 """
 
-from __future__ import print_function
-import os, numpy, PIL, sys
+from __future__ import print_function, division
+import os
+import sys
+import argparse
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 from PIL import Image
 
 
 # Adjustable parameters - os.getcwd() returns the current working directory
 directory = os.getcwd()
-extensions = [".png", ".PNG"] # WARNING: extensions must be 4 characters long
-
-# Optionally adjust parameters with command-line arguments
-if len(sys.argv) > 1:
-    # Read first cmd-line arg as directory param
-    directory = sys.argv[1]
-
-    # Read all remaining as extensions
-    if len(sys.argv) > 2:
-        # Overwrite default extensions
-        extensions = []
-
-        # Record new extensions
-        for extension in sys.argv[2:]:
-            extensions.append(extension)
-
-print("reading images from %s\nlooking for extensions "% directory, end='')
-print(extensions)
-
-# Access all PNG files in directory
-allfiles=os.listdir(directory)
-imlist=["".join([directory, filename]) for filename in allfiles if filename[-4:] in extensions]
-
-# Exit with error message if no images found
-if len(imlist) == 0:
-    print("error: no images found in %s" % directory)
-    sys.exit(-1)
-
-# Assuming all images are the same size, get dimensions of first image
-w,h=Image.open(imlist[0]).size
-N=len(imlist)
-
-# Create a numpy array of floats to store the average (assume RGB images)
-arr=numpy.zeros((h,w,3),numpy.float)
-
-# Build up average pixel intensities, casting each image as an array of floats
-for im in imlist:
-    imarr=numpy.array(Image.open(im),dtype=numpy.float)
-    arr=arr+imarr/N
-
-# Round values in array and cast as 8-bit integer
-arr=numpy.array(numpy.round(arr),dtype=numpy.uint8)
-
-# Generate, save and preview final image
-out=Image.fromarray(arr,mode="RGB")
-outfile = "".join([directory, "average", extensions[0]])
-out.save(outfile)
-print("averaged image saved to %s" % outfile)
-#out.show()
+extensions = [".png", ".PNG"]
+
+def load(path):
+    """Decode an image to an array, converting palette images to RGB."""
+    image = Image.open(path)
+    if image.mode == 'P':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+def accumulator(dtype, count):
+    """Return the dtype to sum count images of dtype in."""
+    if np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2 \
+            and count <= 2 ** 32 // 2 ** (8 * np.dtype(dtype).itemsize):
+        return np.uint32
+    return np.float32
+
+def mean(paths, first, threads):
+    """Return the mean of the images at paths as float32."""
+    total = np.zeros(first.shape, dtype=accumulator(first.dtype, len(paths)))
+    pool = ThreadPool(threads)
+    for image in pool.imap_unordered(load, paths, chunksize=4):
+        np.add(total, image, out=total, casting='unsafe')
+    pool.close()
+    return np.true_divide(total, len(paths), dtype=np.float32)
+
+def volume(paths, first, threads, path):
+    """Decode the images at paths into a memory-mapped .npy volume at path
+    and return it.
+    """
+    stack = np.lib.format.open_memmap(
+            path, mode='w+', dtype=first.dtype,
+            shape=(len(paths),) + first.shape)
+
+    def fill(i):
+        stack[i] = load(paths[i])
+
+    pool = ThreadPool(threads)
+    pool.map(fill, range(len(paths)), chunksize=4)
+    pool.close()
+    return stack
+
+def sigma_clip(chunk, sigma, iterations=3):
+    """Return the mean along the first axis of chunk leaving out values
+    more than sigma standard deviations from the mean, repeatedly.
+    """
+    chunk = chunk.astype(np.float32)
+    keep = np.ones(chunk.shape, dtype=bool)
+    for _ in range(iterations):
+        count = np.maximum(keep.sum(axis=0), 1)
+        centre = np.where(keep, chunk, 0).sum(axis=0) / count
+        spread = np.sqrt(
+                np.where(keep, (chunk - centre) ** 2, 0).sum(axis=0) / count)
+        clipped = np.abs(chunk - centre) <= sigma * spread
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+    count = np.maximum(keep.sum(axis=0), 1)
+    return np.where(keep, chunk, 0).sum(axis=0) / count
+
+def reduce_volume(stack, method, sigma, chunk_bytes):
+    """Return the median or sigma-clipped mean of a volume, reading it a
+    band of rows at a time.
+    """
+    row_bytes = stack[:, :1].size * 4 # as float32
+    rows = max(1, chunk_bytes // row_bytes)
+    out = np.empty(stack.shape[1:], dtype=np.float32)
+    for top in range(0, stack.shape[1], rows):
+        band = stack[:, top:top + rows]
+        if method == 'median':
+            out[top:top + rows] = np.median(band, axis=0)
+        else:
+            out[top:top + rows] = sigma_clip(band, sigma)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Average all the images in a directory.')
+    parser.add_argument(
+            'directory', nargs='?', default=directory,
+            help='directory to read images from (default: current)')
+    parser.add_argument(
+            'extensions', nargs='*', default=extensions,
+            help='read files ending with any of these (default: .png .PNG)')
+    parser.add_argument(
+            '--method', choices=['mean', 'median', 'sigma'], default='mean',
+            help='plain mean, median, or sigma-clipped mean (default: mean)')
+    parser.add_argument(
+            '--sigma', type=float, default=3,
+            help='clip values this many standard deviations from the mean '
+            '(default: 3)')
+    parser.add_argument(
+            '--threads', type=int, default=4,
+            help='number of images to decode at once (default: 4)')
+    parser.add_argument(
+            '--chunk', type=int, default=64,
+            help='MB of the volume to reduce at once (default: 64)')
+    parser.add_argument(
+            '--volume',
+            help='keep the volume in this .npy file rather than a temporary '
+            'one')
+    parser.add_argument(
+            '-o', '--output',
+            help='file to save to (default: average<first extension> in '
+            'the directory)')
+    args = parser.parse_args()
+
+    print("reading images from %s\nlooking for extensions " % args.directory,
+            end='')
+    print(args.extensions)
+
+    # Access all matching files in directory
+    imlist = [
+            os.path.join(args.directory, filename)
+            for filename in sorted(os.listdir(args.directory))
+            if filename.endswith(tuple(args.extensions))
+            and not filename.startswith("average")]
+
+    # Exit with error message if no images found
+    if len(imlist) == 0:
+        print("error: no images found in %s" % args.directory)
+        sys.exit(-1)
+
+    # Assuming all images are the same size and mode, get them from the first
+    first = load(imlist[0])
+
+    if args.method == 'mean':
+        arr = mean(imlist, first, args.threads)
+    else:
+        path = args.volume
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.npy', dir=args.directory)
+            os.close(fd)
+        try:
+            stack = volume(imlist, first, args.threads, path)
+            arr = reduce_volume(
+                    stack, args.method, args.sigma, args.chunk * 2 ** 20)
+            del stack
+        finally:
+            if args.volume is None:
+                os.remove(path)
+
+    # Round values in array and cast back to the images' type
+    if np.issubdtype(first.dtype, np.integer):
+        arr = np.round(arr)
+    arr = arr.astype(first.dtype)
+
+    # Generate and save final image
+    out = Image.fromarray(arr)
+    outfile = args.output or os.path.join(
+            args.directory, "average" + args.extensions[0])
+    out.save(outfile)
+    print("averaged %d images with %s, saved to %s" % (
+        len(imlist), args.method, outfile))
+
+if __name__ == "__main__":
+    main()
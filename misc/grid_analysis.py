@@ -1,46 +1,34 @@
 from __future__ import print_function
 
-import sys, glob, re
+import sys
 
-import scipy.misc
-import scipy.ndimage as sn
-import scipy.signal as ssig
-import scipy.stats as sstat
 import numpy as np
 
+import zstack
+
 directory = '/home/alfred/waterscope/images/grid-sweep/'
 if len(sys.argv) > 1:
     directory = sys.argv[1]
 
-# Save data points in the following lists
-zs = []
-grids = []
+# Read every slice once into the cached volume (or reuse it)
+stack = zstack.ZStack(directory)
+zs = stack.z.tolist()
 
 # Find grid dimensions
-
-
-# Iterate through files
-for infile in glob.glob("".join([directory, 'z*.png'])):
-    # Read image
-    image = scipy.misc.imread(infile)
-
-    # Store data point for plot
-    zs.append(int(re.search(r'\d+', infile).group())) # extracts int from str
-    
-
-    fms.append(image[y, x]) # extracts pixel from img
-
-# Sort lists (glob doesn't order)
-fms = [fms for _, fms in sorted(zip(zs, fms))]
-zs = sorted(zs)
-
-# Apply filter
-#fms = ssig.medfilt(fms, 11)
-
-# Display data
+n, rows, cols = stack.volume.shape
+print('%d slices of %dx%d grids' % (n, cols, rows))
+
+# Sample standard deviation of every grid pixel's curve at once (as
+# scipy.stats.tstd gives for one curve), a band of rows at a time
+stds = np.empty((rows, cols))
+for top in range(0, rows, 64):
+    band = np.asarray(stack.volume[:, top:top + 64], dtype=np.float64)
+    stds[top:top + 64] = band.std(axis=0, ddof=1)
+
+# Display data: the std map and the curve of the most varied grid pixel
+print('stds = ', end='')
+print(stds.tolist())
+y, x = np.unravel_index(np.argmax(stds), stds.shape)
 print('plot(', end='')
 print(zs, end=',')
-print(fms, end=')\n')
-
-print(sstat.tstd(fms))
-#print(sstat.kurtosis(fms))
+print(stack.curve(x, y).tolist(), end=')\n')
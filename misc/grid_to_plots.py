@@ -1,39 +1,28 @@
 from __future__ import print_function
 
-import sys, glob, re
+import sys
 
-import scipy.misc
-import scipy.ndimage as sn
 import scipy.signal as ssig
 import scipy.stats as sstat
-import numpy as np
+
+import zstack
 
 directory = '/home/alfred/waterscope/images/grid-sweep/'
 
 #'''
-# Take cmd-line args (which pixel to read)
+# Take cmd-line args (which pixel to read, optionally which directory)
 if len(sys.argv) < 3:
     sys.exit(-1)
 x = int(sys.argv[1])
 y = int(sys.argv[2])
+if len(sys.argv) > 3:
+    directory = sys.argv[3]
 #'''
 
-# Save data points in the following lists
-zs = []
-fms = []
-
-# Iterate through files
-for infile in glob.glob("".join([directory, 'z*.png'])):
-    # Read image
-    image = scipy.misc.imread(infile)
-
-    # Store data point for plot
-    zs.append(int(re.search(r'\d+', infile).group())) # extracts int from str
-    fms.append(image[y, x]) # extracts pixel form img
-
-# Sort lists (glob doesn't order)
-fms = [fms for _, fms in sorted(zip(zs, fms))]
-zs = sorted(zs)
+# Read the pixel from every slice of the cached volume (built on first use)
+stack = zstack.ZStack(directory)
+zs = stack.z.tolist()
+fms = stack.curve(x, y).tolist()
 
 # Apply filter
 #fms = ssig.medfilt(fms, 11)
@@ -1,188 +1,331 @@
 import sys
 import time
 import os
+import argparse
+import heapq
 
 import cv2
 import numpy as np
 import scipy.signal as ssig
 from statsmodels import robust as smrobust
 
-# Read frames from file
-path = sys.argv[1]
-cap = cv2.VideoCapture(path)
+# Shared modules live in the directory above
+sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import align
+import archive
+import metrics
+import tiles
 
-# Get video properties
-# resolution
-width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-# number of frames (.h264 not supported - manual counting)
-frame_count = 0 # set to n != 0 to only read first n frames of video
-if frame_count == 0:
-    while True:
-        # Read frame - returns False to flag if failed
-        flag, _ = cap.read()
+def read_frames(path):
+    """Yield (frame, grayscale frame) for every frame of the video at path,
+    or of the raw archive (archive.py) at path if it is a .npy file. An
+    archive's frames are already grayscale and are mapped rather than
+    decoded.
+    """
+    if path.endswith('.npy'):
+        frames, _ = archive.open_archive(path)
+        for gray in frames:
+            yield gray, gray
+        return
+
+    # Read frames from file
+    cap = cv2.VideoCapture(path)
+    try:
+        while True:
+            # Read frame - returns False to flag if failed
+            flag, frame = cap.read()
+            if not flag: # end of video
+                break
+
+            # Convert to grayscale
+            yield frame, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    finally:
+        # Done with video
+        cap.release()
+
+def analyse(path, args):
+    """Read the video or archive at path and return the MAD of every grid
+    pixel's normalised focus curve, along with the sharpest frame.
+    """
+    focus_measure = metrics.get(args.metric)
+    grid_size = args.tile
+
+    # Initialise data storage structures. The number of frames isn't known up
+    # front (.h264 not supported) so the grids go in a store which grows as
+    # we go. It is created once the first frame gives the resolution.
+    store = None
+
+    # Frames are lined up with the first one if asked to, since the field of
+    # view drifts during the sweep
+    aligner = None
 
-        if not flag: # end of video
-            # Reset video reader
-            cap = cv2.VideoCapture(path)
+    # Keep a record of the sharpest frames as a min-heap of (fm, frame
+    # number, frame) so that at most args.keep frames are held at once
+    sharpest = []
+
+    # Iterate through frames, decoding each exactly once
+    frame_num = 0
+    for frame, gray in read_frames(path):
+        if args.frames and frame_num == args.frames:
             break
 
-        # Count frame
-        frame_count += 1
-        print("counting frames: %d" % frame_count, end='\r')
-    print()
-else:
-    print("only reading first %d frames" % frame_count)
-
-# Create grids
-grid_size = 8
-gridxs = range(0, width, grid_size)
-gridys = range(0, height, grid_size)
-
-# Initialise data storage structures
-#fms = np.empty(frame_count)
-max_fm = -100
-max_fm_num = -1
-grids = np.empty((frame_count, len(gridys), len(gridxs)))
-
-# Keep a record of the sharpest frame
-sharpest = np.empty((width, height))
-
-# Iterate through frames
-for frame_num in range(frame_count):
-    # Read frame
-    _, frame = cap.read()
-
-    # Convert to grayscale
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    
-    # Apply Laplace transform to whole image
-    lap = cv2.Laplacian(frame, cv2.CV_64F)
-    
-    # Calculate overall fm (variance of laplace)
-    fm = np.var(lap)
-
-    # Check to see if we have a new sharpest frame
-    if fm > max_fm:
-        max_fm = fm
-        max_fm_num = frame_num
-        sharpest = frame
-    
-    # Calculate grid fms
-    for y in range(len(gridys)-1):
-        for x in range(len(gridxs)-1):
-            grids[frame_num, y, x] = lap[
-                    gridys[y]:gridys[y+1],
-                    gridxs[x]:gridxs[x+1]].var()
-    
-    # Output progress - this can take a while!
-    #print("processing frame %d/%d (%d%%)" % (
-    print("processing frames {:d}/{:d} ({:.0%})".format(
-        frame_num + 1,
-        frame_count,
-        (frame_num + 1) / frame_count), end='\r')
-
-# Done with video
-cap.release()
-
-# Avoid carriage return (/r) overwrite and output sharpest frame number
-print("\nsharpest frame was %d/%d" % (max_fm_num, frame_count))
-
-# Filter noise
-#fms = ssig.medfilt(fms)
-grids = ssig.medfilt(grids)
-
-# Normalise across each grid pixel. Temporarily ignore divide by 0 errors.
-with np.errstate(invalid='ignore'):
-    grids = (grids - np.amin(grids, axis=0)) / np.ptp(grids, axis=0)
-
-# Initialise fov mask
-fov = np.zeros((height, width), dtype=np.bool)
-while True:
-    # Loop through varying thresholds
-    for thresh in range(15, 25, 1):
-
-        for y in range(len(gridys)):
-            for x in range(len(gridxs)):
-                # Analyse curve shape for this grid pixel
-                curve = grids[:,y,x]
-                
-                # MAD (median absolute deviation) sums the absolute difference
-                # of each value from the median and divides this by N
-                s = smrobust.mad(curve)
-
-                # Apply threshold to generate an FoV mask
-                if s > thresh / 100:
-                    fov[
-                            y*grid_size : (y+1) * grid_size,
-                            x*grid_size : (x+1) * grid_size] = True
-                else:
-                    fov[
-                            y*grid_size : (y+1) * grid_size,
-                            x*grid_size : (x+1) * grid_size] = False
-
-        ## Use morphological transforms to clean up mask
-        ker = np.ones((grid_size * 2, grid_size * 2))
-        # cv2 morph functions work with images. bool mask to grayscale:
-        fov_morphed = np.array(fov * 255, dtype=np.uint8)
-        # Initial erode gets rid of small specks outside fov
-        fov_morphed = cv2.erode(fov_morphed, ker, iterations=1)
-        # Double dilate to remove medium specks inside fov
-        fov_morphed = cv2.dilate(fov_morphed, ker, iterations=3)
-        # Erode to restore to roughly original area
-        fov_morphed = cv2.erode(fov_morphed, ker, iterations=1)
-    
-        # cv2 contours allow us to outline shapes generated and get centres
-        cnts = cv2.findContours(
-                fov_morphed,
-                cv2.RETR_EXTERNAL,
-                cv2.CHAIN_APPROX_SIMPLE)
-        cnts = cnts[1] # some kinda cv2/cv3 peculiarity
-
-        ## Now we have all the info to construct our fov image
-        sharpCopy = np.array(sharpest) # copy values explicitly
-        # Black out parts outside of the fov
-        sharpCopy[np.invert(fov_morphed.astype(bool))] = 0
-        # Get largest contour
-        largest_cnt = cnts[0]
-        for c in cnts:
-            if cv2.contourArea(c) > cv2.contourArea(largest_cnt):
-                largest_cnt = c
-        
-        # Draw largest contour and its centre
-        M = cv2.moments(largest_cnt)
-        cX = int(M["m10"] / M["m00"])
-        cY = int(M["m01"] / M["m00"])
-        cv2.drawContours(sharpCopy, [largest_cnt], -1, (255, 0, 255), 2)
-        cv2.circle(sharpCopy, (cX, cY), 7, (255,0,255), -1)
-    
-        # Display current threshold value
-        cv2.putText(
-                sharpCopy,
-                "threshold: {:.2f}".format(thresh / 100),
-                (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (0,255,255))
-
-        # Display % coverage of fov
-        cv2.putText(
-                sharpCopy,
-                "fov coverage: {:.1%}".format(
-                    cv2.contourArea(largest_cnt) / width / height),
-                (10, 60),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (0,255,255))
-        
-        # Display image
-        cv2.imshow('fov', sharpCopy)
-
-        # Save image
-        vid_name, _ = os.path.splitext(path)
-        cv2.imwrite("%s-%d.png" % (vid_name, thresh), sharpCopy) 
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            cv2.destroyAllWindows()
-            sys.exit()
+        # Create grids
+        if store is None:
+            store = tiles.GridStore(
+                    tiles.grid_shape(gray.shape, grid_size),
+                    path=args.store)
+
+        # Register to the first frame
+        if args.align is not None:
+            if aligner is None:
+                aligner = align.Aligner(gray, args.align)
+            shift = aligner.shift(gray)
+            gray = align.translate(gray, *shift)
+            frame = align.translate(frame, *shift)
+
+        # Apply Laplace transform to whole image
+        lap = metrics.laplacian(gray)
+
+        # Calculate overall fm
+        fm = focus_measure(gray)
+
+        # Check to see if we have a new sharpest frame
+        if len(sharpest) < args.keep:
+            heapq.heappush(sharpest, (fm, frame_num, frame))
+        elif fm > sharpest[0][0]:
+            heapq.heapreplace(sharpest, (fm, frame_num, frame))
+
+        # Calculate grid fms (variance of laplace in each tile)
+        store.append(tiles.tile_var(lap, grid_size))
+        frame_num += 1
+
+        # Output progress - this can take a while!
+        print("processing frame {:d}".format(frame_num), end='\r')
+    frame_count = frame_num
+
+    # Avoid carriage return (/r) overwrite and output sharpest frame numbers
+    sharpest.sort(reverse=True)
+    print("\nsharpest frames were %s of %d" % (
+        ", ".join([str(num) for _, num, _ in sharpest]), frame_count))
+    return curve_mads(store.array()), sharpest[0][2]
+
+def curve_mads(grids, band_rows=16):
+    """Return the MAD of every grid pixel's normalised focus curve, given
+    the (frames, rows, cols) grids.
+
+    The grids are worked through band_rows rows at a time, so that a
+    memory-mapped store (--store) is never copied into RAM whole.
+    """
+    rows = grids.shape[1]
+    mads = np.empty(grids.shape[1:])
+    for top in range(0, rows, band_rows):
+        bottom = min(top + band_rows, rows)
+
+        # Filter noise. The 3x3x3 median filter needs a row either side of
+        # the band to give the same result as filtering the whole array
+        lo, hi = max(top - 1, 0), min(bottom + 1, rows)
+        band = ssig.medfilt(grids[:, lo:hi])[:, top - lo:bottom - lo]
+
+        # Normalise across each grid pixel. Temporarily ignore divide by 0
+        # errors.
+        with np.errstate(invalid='ignore'):
+            band = (band - np.amin(band, axis=0)) / np.ptp(band, axis=0)
+
+        # Analyse curve shape for every grid pixel at once. MAD (median
+        # absolute deviation) is the median of the absolute difference of
+        # each value from the median (scaled to be consistent with the
+        # standard deviation).
+        mads[top:bottom] = smrobust.mad(band, axis=0)
+    return mads
+
+def fov_masks(mads, thresholds, grid_size, shape):
+    """Apply every threshold to the MAD map at once, returning a stack of
+    per-pixel FoV masks, one for each threshold.
+    """
+    thresholds = np.asarray(thresholds)[:, np.newaxis, np.newaxis]
+    masks = mads[np.newaxis] > thresholds
+    return tiles.expand(masks, grid_size, shape)
+
+def clean(fov, grid_size):
+    """Use morphological transforms to clean up a mask. Return it as a
+    grayscale image along with its largest contour (or None if it is empty).
+    """
+    ker = np.ones((grid_size * 2, grid_size * 2))
+    # cv2 morph functions work with images. bool mask to grayscale:
+    fov_morphed = np.array(fov * 255, dtype=np.uint8)
+    # Initial erode gets rid of small specks outside fov
+    fov_morphed = cv2.erode(fov_morphed, ker, iterations=1)
+    # Double dilate to remove medium specks inside fov
+    fov_morphed = cv2.dilate(fov_morphed, ker, iterations=3)
+    # Erode to restore to roughly original area
+    fov_morphed = cv2.erode(fov_morphed, ker, iterations=1)
+
+    # cv2 contours allow us to outline shapes generated and get centres
+    cnts = cv2.findContours(
+            fov_morphed,
+            cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE)
+    # cv3 returns (image, cnts, hierarchy) but cv4 (cnts, hierarchy)
+    cnts = cnts[-2]
+
+    # Get largest contour
+    if len(cnts) == 0:
+        return fov_morphed, None
+    largest_cnt = cnts[0]
+    for c in cnts:
+        if cv2.contourArea(c) > cv2.contourArea(largest_cnt):
+            largest_cnt = c
+    return fov_morphed, largest_cnt
+
+def summarise(cnt, shape):
+    """Return the fraction of the frame covered by a contour and the
+    coordinates of its centre.
+    """
+    if cnt is None:
+        return 0.0, None
+    M = cv2.moments(cnt)
+    if M["m00"] == 0:
+        return 0.0, None
+    cX = int(M["m10"] / M["m00"])
+    cY = int(M["m01"] / M["m00"])
+    return cv2.contourArea(cnt) / shape[0] / shape[1], (cX, cY)
+
+def render(sharpest, fov_morphed, cnt, thresh, coverage, centre):
+    """Construct our fov image from the sharpest frame."""
+    sharpCopy = np.array(sharpest) # copy values explicitly
+    # Black out parts outside of the fov
+    sharpCopy[np.invert(fov_morphed.astype(bool))] = 0
+
+    # Draw largest contour and its centre
+    if cnt is not None:
+        cv2.drawContours(sharpCopy, [cnt], -1, (255, 0, 255), 2)
+    if centre is not None:
+        cv2.circle(sharpCopy, centre, 7, (255,0,255), -1)
+
+    # Display current threshold value
+    cv2.putText(
+            sharpCopy,
+            "threshold: {:.2f}".format(thresh / 100),
+            (10, 30),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (0,255,255))
+
+    # Display % coverage of fov
+    cv2.putText(
+            sharpCopy,
+            "fov coverage: {:.1%}".format(coverage),
+            (10, 60),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (0,255,255))
+    return sharpCopy
+
+def batch(path, args):
+    """Write the fov image, mask and a summary for every threshold and
+    return.
+    """
+    mads, sharpest = analyse(path, args)
+    shape = sharpest.shape[:2]
+    thresholds = range(args.thresholds[0], args.thresholds[1])
+    masks = fov_masks(
+            mads, [t / 100 for t in thresholds], args.tile, shape)
+
+    vid_name, _ = os.path.splitext(path)
+    with open("%s-fov.csv" % vid_name, 'w') as summary:
+        summary.write("threshold,coverage,centre_x,centre_y\n")
+        for thresh, fov in zip(thresholds, masks):
+            fov_morphed, cnt = clean(fov, args.tile)
+            coverage, centre = summarise(cnt, shape)
+
+            # Save image and the mask itself
+            cv2.imwrite("%s-%d.png" % (vid_name, thresh), render(
+                sharpest, fov_morphed, cnt, thresh, coverage, centre))
+            cv2.imwrite("%s-mask-%d.png" % (vid_name, thresh), fov_morphed)
+
+            summary.write("%.2f,%.4f,%s,%s\n" % (
+                (thresh / 100, coverage) + (centre or ('', ''))))
+    print("wrote %d masks for %s" % (len(masks), path))
+
+def interactive(path, args):
+    """Cycle through the thresholds on screen forever, saving each fov image
+    as we go. Press q to quit.
+    """
+    mads, sharpest = analyse(path, args)
+    shape = sharpest.shape[:2]
+    thresholds = range(args.thresholds[0], args.thresholds[1])
+    masks = fov_masks(
+            mads, [t / 100 for t in thresholds], args.tile, shape)
+
+    while True:
+        # Loop through varying thresholds
+        for thresh, fov in zip(thresholds, masks):
+            fov_morphed, cnt = clean(fov, args.tile)
+            coverage, centre = summarise(cnt, shape)
+            sharpCopy = render(
+                    sharpest, fov_morphed, cnt, thresh, coverage, centre)
+
+            # Display image
+            cv2.imshow('fov', sharpCopy)
+
+            # Save image
+            vid_name, _ = os.path.splitext(path)
+            cv2.imwrite("%s-%d.png" % (vid_name, thresh), sharpCopy)
+
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                cv2.destroyAllWindows()
+                sys.exit()
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Find the FoV in a video of a focus sweep.')
+    parser.add_argument(
+            'paths', nargs='+', metavar='path',
+            help='video of the sweep (several with --batch)')
+    parser.add_argument(
+            '--metric', choices=sorted(metrics.measures),
+            default='laplace_var',
+            help='focus measure used to pick the sharpest frame '
+            '(default: laplace_var)')
+    parser.add_argument(
+            '--tile', type=int, default=8,
+            help='size of the square tiles the FoV is built from '
+            '(default: 8)')
+    parser.add_argument(
+            '--frames', type=int, default=0,
+            help='only read the first n frames of the video')
+    parser.add_argument(
+            '--keep', type=int, default=1,
+            help='number of sharpest frames to keep and report (default: 1)')
+    parser.add_argument(
+            '--store',
+            help='memory-map the tile grids to this file instead of keeping '
+            'them in RAM')
+    parser.add_argument(
+            '--align', type=int, nargs='?', const=2, metavar='DEPTH',
+            help='line frames up with the first before comparing tiles, '
+            'estimating shifts at 1/2^DEPTH resolution (default DEPTH: 2)')
+    parser.add_argument(
+            '--thresholds', type=int, nargs=2, default=[15, 25],
+            metavar=('START', 'STOP'),
+            help='range of MAD thresholds to try, in hundredths '
+            '(default: 15 25)')
+    parser.add_argument(
+            '--batch', action='store_true',
+            help='don\'t display anything. For each video write the fov '
+            'image and mask for every threshold, plus a csv summary, '
+            'then exit')
+    args = parser.parse_args()
+
+    if args.batch:
+        for path in args.paths:
+            batch(path, args)
+    elif len(args.paths) > 1:
+        parser.error('only one video can be shown at a time without --batch')
+    else:
+        interactive(args.paths[0], args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""zstack.py
+
+Cached volume store for a directory of z-sweep images (z0.png, z1.png, ...).
+
+The first time a directory is used, every z*.png in it is decoded once into
+a memory-mapped (z, h, w) volume, zstack.npy, alongside an index,
+zstack.json, of the z values (sorted) and the files they came from. Later
+uses just map the volume again, unless the files have changed since, so
+per-pixel curves, per-tile statistics and whole-volume summaries cost a few
+milliseconds rather than a decode of every image. Colour images are stored as
+their luma.
+
+With --align, each slice is registered to the first by phase correlation (see
+align.py) as it is ingested, so that a pixel's curve follows the same point
+of the sample although the field of view drifts from slice to slice. The
+shifts applied are kept in the index. A cache built with different alignment
+settings is rebuilt.
+
+Usage:
+
+    python zstack.py DIRECTORY [--align] curve X Y
+    python zstack.py DIRECTORY tiles SIZE [--stat var]
+    python zstack.py DIRECTORY summary
+"""
+
+from __future__ import print_function, division
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from PIL import Image
+
+# Shared modules live in the directory above
+sys.path.insert(
+        0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tiles
+import align
+
+
+volume_name = 'zstack.npy'
+index_name = 'zstack.json'
+
+def load(path):
+    """Decode an image to a 2D array, converting colour to luma."""
+    image = Image.open(path)
+    if image.mode not in ('L', 'I', 'I;16', 'F'):
+        image = image.convert('L')
+    return np.asarray(image)
+
+def find(directory):
+    """Return the z*.png files in directory as (z, filename) pairs sorted by
+    z.
+    """
+    found = []
+    for path in glob.glob(os.path.join(directory, 'z*.png')):
+        name = os.path.basename(path)
+        match = re.search(r'\d+', name)
+        if match: # extracts int from file name
+            found.append((int(match.group()), name))
+    return sorted(found)
+
+def ingest(directory, threads=4, align_depth=None):
+    """Decode every z*.png in directory into the volume and write its index.
+    Return the index.
+
+    If align_depth is given, register every slice to the first, estimating
+    shifts at that pyramid depth, and record the shifts in the index.
+    """
+    found = find(directory)
+    if not found:
+        raise IOError('no z*.png images found in %s' % directory)
+    first = load(os.path.join(directory, found[0][1]))
+    volume = np.lib.format.open_memmap(
+            os.path.join(directory, volume_name), mode='w+',
+            dtype=first.dtype, shape=(len(found),) + first.shape)
+
+    def fill(i):
+        volume[i] = load(os.path.join(directory, found[i][1]))
+
+    pool = ThreadPool(threads)
+    pool.map(fill, range(len(found)))
+    pool.close()
+
+    # Shift each slice in place, through a copy since translate() can't
+    # overlap its input and output.
+    shifts = np.zeros((len(found), 2))
+    if align_depth is not None:
+        if volume.dtype != np.uint8:
+            raise ValueError('only 8 bit images can be aligned')
+        shifts = align.align_stack(volume, depth=align_depth)
+        for i, (dy, dx) in enumerate(shifts):
+            if dy or dx:
+                align.translate(np.array(volume[i]), dy, dx, out=volume[i])
+    volume.flush()
+    del volume
+
+    index = {
+            'z': [z for z, _ in found],
+            'files': [name for _, name in found],
+            'mtime': _mtime(directory, found),
+            'align': align_depth,
+            'shifts': shifts.tolist()}
+    with open(os.path.join(directory, index_name), 'w') as f:
+        json.dump(index, f)
+    return index
+
+def _mtime(directory, found):
+    """Return the latest modification time of the files found."""
+    return max(
+            os.path.getmtime(os.path.join(directory, name))
+            for _, name in found)
+
+class ZStack(object):
+    """This class answers queries about a z-sweep directory from its cached
+    volume, ingesting the directory first if there is no up to date cache.
+
+    volume is the (z, h, w) memory-mapped array and z the sorted z values of
+    its slices. If align_depth is given the slices are registered to the
+    first (see ingest()), and shifts holds the (dy, dx) applied to each.
+    """
+    def __init__(self, directory, rebuild=False, align_depth=None):
+        self.directory = directory
+        self.align_depth = align_depth
+        index = None if rebuild else self._index()
+        if index is None:
+            index = ingest(directory, align_depth=align_depth)
+        self.z = np.array(index['z'])
+        self.files = index['files']
+        self.shifts = np.array(index['shifts'])
+        self.volume = np.load(
+                os.path.join(directory, volume_name), mmap_mode='r')
+
+    def _index(self):
+        """Return the cached index, or None if it is missing or stale."""
+        try:
+            with open(os.path.join(self.directory, index_name)) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        found = find(self.directory)
+        if [name for _, name in found] != index['files'] or \
+                _mtime(self.directory, found) != index['mtime'] or \
+                index.get('align') != self.align_depth or \
+                'shifts' not in index or \
+                not os.path.exists(
+                    os.path.join(self.directory, volume_name)):
+            return None
+        return index
+
+    def curve(self, x, y):
+        """Return the value of pixel (x, y) in every slice."""
+        return np.array(self.volume[:, y, x])
+
+    def curves(self, xs, ys):
+        """Return a (z, n) array of the curves of n pixels at once."""
+        return np.array(self.volume[:, ys, xs])
+
+    def tile_stats(self, size, stat='mean'):
+        """Return a (z, rows, cols) array of the mean or variance of every
+        size x size tile of every slice.
+        """
+        function = {'mean': tiles.tile_mean, 'var': tiles.tile_var}[stat]
+        return np.array([function(image, size) for image in self.volume])
+
+    def summary(self, chunk_rows=64):
+        """Return a dict of per-slice mean, std, min and max, and the z at
+        which each pixel peaks, reading the volume a band of rows at a
+        time.
+        """
+        n, rows = self.volume.shape[:2]
+        sums = np.zeros(n)
+        squares = np.zeros(n)
+        lows = np.full(n, np.inf)
+        highs = np.full(n, -np.inf)
+        peak = np.empty(self.volume.shape[1:], dtype=self.z.dtype)
+        for top in range(0, rows, chunk_rows):
+            band = self.volume[:, top:top + chunk_rows]
+            flat = band.reshape(n, -1)
+            sums += flat.sum(axis=1, dtype=np.float64)
+            squares += np.einsum(
+                    'ij,ij->i', flat, flat, dtype=np.float64)
+            lows = np.minimum(lows, flat.min(axis=1))
+            highs = np.maximum(highs, flat.max(axis=1))
+            peak[top:top + chunk_rows] = self.z[np.argmax(band, axis=0)]
+        count = self.volume[0].size
+        mean = sums / count
+        return {
+                'z': self.z,
+                'mean': mean,
+                'std': np.sqrt(np.maximum(squares / count - mean * mean, 0)),
+                'min': lows,
+                'max': highs,
+                'peak_z': peak}
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Query a directory of z-sweep images through a '
+            'cached volume.')
+    parser.add_argument('directory', help='directory of z*.png images')
+    parser.add_argument(
+            '--rebuild', action='store_true',
+            help='decode the images again even if the cache is up to date')
+    parser.add_argument(
+            '--align', action='store_true',
+            help='register slices to the first')
+    parser.add_argument(
+            '--align-depth', type=int, default=2, metavar='DEPTH',
+            help='pyramid depth to estimate alignment shifts at (default 2)')
+    queries = parser.add_subparsers(dest='query')
+    curve = queries.add_parser('curve', help='print one pixel\'s curve')
+    curve.add_argument('x', type=int)
+    curve.add_argument('y', type=int)
+    tile = queries.add_parser(
+            'tiles', help='print a statistic of each tile in each slice')
+    tile.add_argument('size', type=int)
+    tile.add_argument('--stat', choices=['mean', 'var'], default='mean')
+    queries.add_parser('summary', help='print per-slice statistics')
+    args = parser.parse_args()
+
+    stack = ZStack(
+            args.directory, args.rebuild,
+            args.align_depth if args.align else None)
+    zs = stack.z.tolist()
+    if args.query == 'curve':
+        print('plot(', end='')
+        print(zs, end=',')
+        print(stack.curve(args.x, args.y).tolist(), end=')\n')
+    elif args.query == 'tiles':
+        stats = stack.tile_stats(args.size, args.stat)
+        for z, grid in zip(zs, stats):
+            print('z = %d' % z)
+            print(grid)
+    elif args.query == 'summary':
+        summary = stack.summary()
+        print('%6s %9s %9s %6s %6s' % ('z', 'mean', 'std', 'min', 'max'))
+        for i, z in enumerate(zs):
+            print('%6d %9.2f %9.2f %6d %6d' % (
+                z, summary['mean'][i], summary['std'][i],
+                summary['min'][i], summary['max'][i]))
+    else:
+        print('%d slices of %dx%d, z %d to %d' % (
+            (len(zs),) + stack.volume.shape[2:0:-1] + (zs[0], zs[-1])))
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,14 @@ Simple script to allow manual movement of servo.
 
 import sys
 
-# I2C communication
-import smbus
-bus = smbus.SMBus(1)
-address = 0x04
+# I2C communication, through the same bus interface sweep.py uses
+import actuator
+bus = actuator.I2CBus(1, 0x04)
 
 # Check for command-line argument
-if len(sys.argv) is not 2:
+if len(sys.argv) != 2:
     print("error: expected exactly one command-line argument")
     sys.exit()
 
 # Cast command-line argument to int and write to Arduino
-bus.write_byte(address, int(sys.argv[1]))
+bus.write(int(sys.argv[1]))
@@ -0,0 +1,442 @@
+"""replay.py
+
+Replay recorded sweeps through the live pipeline, with no camera or servo, to
+check changes to it for throughput and chosen-angle regressions.
+
+A recording is a video_sweep.py .h264 (decoded with cv2) or a raw picamera
+YUV dump (format='yuv', rows padded to 32 bytes and height to 16), together
+with its schedule, or a raw archive written by archive.Archive, whose index
+already holds each frame's angle. A schedule is a JSON file written
+alongside by video_sweep.py,
+
+    {"framerate": 40, "resolution": [1296, 972],
+     "moves": [[0.0, 6], [0.1, 11], ...]}
+
+where each move is the time in seconds since the recording started at which
+the servo was told to move to an angle. Frame i was captured at
+i / framerate, so it belongs to the angle last commanded before then, and
+the recording splits into one run of frames per angle, starting with the
+frames captured while the servo was still travelling.
+
+A ReplayCamera stands in for picamera and sweep.servo is swapped for an
+actuator on a ReplayBus, so sweep.sweep() and sweep.search() run unchanged:
+every time the Sweeper moves the servo, the camera starts playing the run of
+frames recorded at the nearest angle from its beginning, holding its last
+frame once it runs out. Settle detection therefore sees the same motion as
+it did live. Settling and statistics are timed in recording time
+(sweep.clock), so the replay can run --speed times faster than real time and
+still choose the same frames as long as the processors keep up.
+
+Usage:
+
+    python replay.py sweep.h264
+    python replay.py field/*.h264 --search coarse --baseline baseline.json
+    python replay.py dump.yuv --schedule dump.json --update
+    python replay.py sweep.npy
+
+With --baseline, each recording's chosen angle and throughput are compared
+with those stored for it and the exit status is 1 if any got worse. --update
+stores the results instead.
+"""
+
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import types
+import bisect
+import argparse
+import threading
+
+import numpy as np
+import scipy.signal
+
+import actuator
+import archive
+
+# sweep.py imports picamera, which a replay never uses.
+try:
+    import picamera
+except ImportError:
+    sys.modules['picamera'] = types.ModuleType('picamera')
+import sweep
+import metrics
+
+
+def schedule_path(path):
+    """Return the default schedule file for the recording at path."""
+    return os.path.splitext(path)[0] + '.json'
+
+def padded(resolution):
+    """Return the (width, height) picamera pads a YUV frame of resolution
+    to.
+    """
+    w, h = resolution
+    return (w + 31) // 32 * 32, (h + 15) // 16 * 16
+
+class Recording(object):
+    """This class holds the frames of a recorded sweep, ready to be written
+    to a Sweeper, and the angle commanded when each was captured.
+
+    frames[i] is a buffer holding at least the padded Y plane of frame i,
+    angles[i] its commanded angle and runs maps each angle to the indices
+    of the frames commanded at it, in order.
+    """
+    def __init__(self, frames, angles, framerate, resolution):
+        self.frames = frames
+        self.angles = list(angles)
+        self.framerate = framerate
+        self.resolution = tuple(resolution)
+        self.runs = {}
+        for i, angle in enumerate(self.angles):
+            self.runs.setdefault(angle, []).append(i)
+
+        # Sweep order: every angle commanded, in the order it first was.
+        self.order = []
+        for angle in self.angles:
+            if angle not in self.order:
+                self.order.append(angle)
+
+    def duration(self):
+        """Return the length of the recording in seconds."""
+        return len(self.frames) / self.framerate
+
+    def run(self, angle):
+        """Return the frame indices of the run recorded nearest angle."""
+        nearest = min(self.runs, key=lambda a: abs(a - angle))
+        return self.runs[nearest]
+
+def load_schedule(path):
+    with open(path) as f:
+        return json.load(f)
+
+def schedule_angles(schedule, count):
+    """Return the angle commanded when each of count frames recorded with
+    schedule was captured.
+    """
+    moves = sorted(schedule['moves'])
+    times = [t for t, _ in moves]
+    angles = []
+    for i in range(count):
+        # Frames before the first move are at its angle, which the servo
+        # was moved to before recording started.
+        move = bisect.bisect_right(times, i / schedule['framerate']) - 1
+        angles.append(moves[max(0, move)][1])
+    return angles
+
+def load_video(path, schedule):
+    """Decode the video at path into a Recording."""
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    frames = []
+    resolution = None
+    while True:
+        flag, frame = cap.read()
+        if not flag: # end of video
+            break
+        if resolution is None:
+            resolution = frame.shape[1], frame.shape[0]
+            stride = padded(resolution)[0]
+        # Keep only the Y plane, padded as picamera would.
+        luma = np.zeros((resolution[1], stride), dtype=np.uint8)
+        cv2.cvtColor(
+                frame, cv2.COLOR_BGR2GRAY, dst=luma[:, :resolution[0]])
+        frames.append(luma)
+    cap.release()
+    if not frames:
+        raise IOError('no frames could be read from %s' % path)
+    return Recording(
+            frames, schedule_angles(schedule, len(frames)),
+            schedule['framerate'], resolution)
+
+def load_yuv(path, schedule, resolution=None):
+    """Map the raw YUV dump at path into a Recording without copying it.
+    resolution defaults to the schedule's.
+    """
+    if resolution is None:
+        resolution = schedule['resolution']
+    fw, fh = padded(resolution)
+    size = fw * fh * 3 // 2
+    dump = np.memmap(path, dtype=np.uint8, mode='r')
+    frames = dump[:len(dump) // size * size].reshape(-1, size)
+    return Recording(
+            frames, schedule_angles(schedule, len(frames)),
+            schedule['framerate'], resolution)
+
+def load_archive(path, framerate=30):
+    """Map an archive written by archive.Archive into a Recording. Its frames
+    were all taken once the servo had settled, so each angle's run has no
+    motion in it; framerate only sets the pace of the replay.
+
+    Frames whose width isn't a multiple of 32 are copied into padded rows,
+    as the Sweeper expects; others are used where they are.
+    """
+    frames, index = archive.open_archive(path)
+    n, h, w = frames.shape
+    if w % 32:
+        padded_frames = np.zeros((n, h, padded((w, h))[0]), dtype=np.uint8)
+        padded_frames[:, :, :w] = frames
+        frames = padded_frames
+    return Recording(frames, index['angle'].tolist(), framerate, (w, h))
+
+def load(path, schedule=None, resolution=None):
+    """Load the recording at path with its schedule, by default the .json
+    file next to it. An archive (.npy) needs no schedule.
+    """
+    if path.endswith('.npy'):
+        return load_archive(path)
+    schedule = load_schedule(schedule or schedule_path(path))
+    if path.endswith('.yuv'):
+        return load_yuv(path, schedule, resolution)
+    return load_video(path, schedule)
+
+class ReplayBus(actuator.FakeBus):
+    """This class is a FakeBus which counts moves, so that a ReplayCamera
+    can tell when a new one has been written even if it is to the same
+    angle.
+    """
+    def __init__(self, angle=0):
+        super(ReplayBus, self).__init__(angle=angle)
+        self.moves = 0
+
+    def write(self, angle):
+        super(ReplayBus, self).write(angle)
+        self.moves += 1
+
+class ReplayCamera(object):
+    """This class plays a Recording to whatever is recording from it, the
+    way picamera would, choosing frames by the angle last written to the
+    bus of servo, an Actuator, and the number of frames since.
+
+    The camera keeps recording time: time() is the time at which the frame
+    being played was captured, counting from the start of the recording.
+    After each frame it waits for any move the frame caused to be written,
+    so with servo and sweep timestamps taken from time(), the same frames
+    are chosen however fast the replay runs. Frames are played at speed
+    times the recording's framerate, or as fast as possible if speed is
+    None. frames counts frames played.
+    """
+    def __init__(self, recording, servo, speed=None):
+        self.recording = recording
+        self.servo = servo
+        self.speed = speed
+        self.resolution = recording.resolution
+        self.framerate = recording.framerate
+        self.frames = 0
+        self.thread = None
+
+        # Camera settings have no effect on a recording, but calibrate()
+        # reads these back.
+        self.exposure_speed = 0
+        self.awb_gains = (1, 1)
+
+    def time(self):
+        return self.frames / self.framerate
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def start_recording(self, output, format=None):
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+                target=self._play, args=(output, self.stop))
+        self.thread.start()
+
+    def wait_recording(self, timeout=0):
+        time.sleep(timeout)
+
+    def stop_recording(self):
+        self.stop.set()
+        self.thread.join()
+        self.thread = None
+
+    def _play(self, output, stop):
+        frames = self.recording.frames
+        bus = self.servo.bus
+        moves = None
+        next_frame = time.time()
+        while not stop.is_set():
+            if self.speed is not None:
+                now = time.time()
+                if now < next_frame:
+                    time.sleep(next_frame - now)
+                next_frame = max(
+                        next_frame + 1.0 / (self.framerate * self.speed),
+                        time.time())
+
+            if bus.moves != moves:
+                # Start again at the beginning of the new angle's run.
+                moves = bus.moves
+                run = self.recording.run(bus.angle)
+                position = 0
+            output.write(frames[run[min(position, len(run) - 1)]])
+            self.servo.wait()
+            position += 1
+            self.frames += 1
+        output.flush()
+
+def replay(recording, search='full', steps=(16, 4, 1), speed=4, **kwargs):
+    """Autofocus on a recording the way autofocus.py does, with the sweep
+    covering every angle it commands, speed times faster than real time.
+    Remaining keyword arguments are passed on to Sweeper.
+
+    Return a dict of the angle chosen, the seconds taken, the frames played,
+    the focus measures taken per second, the servo moves made and the speed
+    up over the recording's duration.
+    """
+    angles = recording.order
+    bus = ReplayBus(angles[0])
+    servo = actuator.Actuator(bus)
+    camera = ReplayCamera(recording, servo, speed)
+    servo.clock = camera.time
+
+    # Swap in the replay's servo and clock, and don't wait for a camera to
+    # calibrate.
+    saved = sweep.servo, sweep.clock, sweep.calibration_time
+    sweep.servo = servo
+    sweep.clock = camera.time
+    sweep.calibration_time = 0
+    start = time.time()
+    try:
+        if search == 'full':
+            fms = sweep.sweep(
+                    angles, camera, recording.resolution,
+                    recording.framerate, **kwargs)
+            fms = [-np.inf if fm is None else fm for fm in fms]
+            if len(fms) >= 3:
+                fms = scipy.signal.medfilt(fms).tolist()
+            angle = angles[fms.index(max(fms))]
+            processed = len(fms)
+            moves = len(fms) + 1
+        else:
+            levels = None
+            if search == 'pyramid':
+                levels = sweep.pyramid_levels(steps)
+            angle, moves, _ = sweep.search(
+                    angles, camera, recording.resolution, steps,
+                    recording.framerate, levels, **kwargs)
+            processed = moves - 1
+        elapsed = time.time() - start
+    finally:
+        servo.close()
+        sweep.servo, sweep.clock, sweep.calibration_time = saved
+
+    return {
+            'angle': angle,
+            'seconds': elapsed,
+            'frames': camera.frames,
+            'fps': processed / elapsed,
+            'moves': moves,
+            'speedup': recording.duration() / elapsed,
+            'speed': speed}
+
+def compare(result, expected, tolerance=0, slowdown=0.2):
+    """Return a list of the ways result is worse than expected: a chosen
+    angle more than tolerance degrees away, or throughput more than
+    slowdown times lower. Throughput is only compared between replays at
+    the same speed.
+    """
+    regressions = []
+    if abs(result['angle'] - expected['angle']) > tolerance:
+        regressions.append('angle %d, expected %d' % (
+            result['angle'], expected['angle']))
+    if result['speed'] == expected.get('speed') and \
+            result['fps'] < expected['fps'] * (1 - slowdown):
+        regressions.append('%.1f fps, expected %.1f' % (
+            result['fps'], expected['fps']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Replay recorded sweeps through the sweep pipeline '
+            'and check for regressions.')
+    parser.add_argument(
+            'recordings', nargs='+',
+            help='.h264 videos or .yuv dumps from video_sweep.py, or .npy '
+            'archives')
+    parser.add_argument(
+            '--schedule',
+            help='angle schedule of the recording (default: the .json file '
+            'next to each recording)')
+    parser.add_argument(
+            '--resolution', type=int, nargs=2, metavar=('W', 'H'),
+            help='resolution of a .yuv dump (default: from the schedule)')
+    parser.add_argument(
+            '--search', choices=['full', 'coarse', 'pyramid'],
+            default='full', help='autofocus strategy to replay')
+    parser.add_argument(
+            '--steps', type=int, nargs='+', default=[16, 4, 1],
+            help='angle step (in scheduled angles) for each level of a '
+            'coarse search')
+    parser.add_argument(
+            '--speed', type=float, default=4,
+            help='replay this many times faster than real time (default: '
+            '4, 0 for as fast as possible)')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument(
+            '--backend', choices=['thread', 'process'], default='thread')
+    parser.add_argument(
+            '--metric', choices=sorted(metrics.measures), default='laplace')
+    parser.add_argument(
+            '--settle-threshold', type=float,
+            help='detect settling from frame differences with this '
+            'threshold instead of a fixed delay')
+    parser.add_argument(
+            '--baseline',
+            help='JSON file of expected results to check against')
+    parser.add_argument(
+            '--update', action='store_true',
+            help='store the results in --baseline instead of checking them')
+    parser.add_argument(
+            '--tolerance', type=int, default=0,
+            help='degrees the chosen angle may move by (default: 0)')
+    parser.add_argument(
+            '--slowdown', type=float, default=0.2,
+            help='fraction throughput may drop by (default: 0.2)')
+    args = parser.parse_args()
+    if args.update and not args.baseline:
+        parser.error('--update needs --baseline')
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print('%-24s %6s %7s %7s %6s %8s  %s' % (
+        'recording', 'angle', 'time s', 'fps', 'moves', 'speedup', 'check'))
+    failed = False
+    for path in args.recordings:
+        recording = load(path, args.schedule, args.resolution)
+        result = replay(
+                recording, args.search, args.steps, args.speed or None,
+                threads=args.threads, backend=args.backend,
+                metric=args.metric, settle_threshold=args.settle_threshold)
+
+        # Results are only comparable for the same search.
+        name = '%s:%s' % (os.path.basename(path), args.search)
+        check = ''
+        if args.update:
+            baseline[name] = result
+            check = 'stored'
+        elif name in baseline:
+            regressions = compare(
+                    result, baseline[name], args.tolerance, args.slowdown)
+            check = '; '.join(regressions) or 'ok'
+            failed = failed or bool(regressions)
+        print('%-24s %6d %7.2f %7.1f %6d %7.1fx  %s' % (
+            os.path.basename(path), result['angle'], result['seconds'],
+            result['fps'], result['moves'], result['speedup'], check))
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,56 +2,97 @@
 
 todo: round input res up to nearest 32/16/8(?)
 todo: script + transistor for resetting arduino
-todo: fix reverse sweep start pos bug
 """
 from __future__ import print_function
 import time
+import functools
 import threading
+import multiprocessing
 
-import smbus
 import numpy as np
-import scipy.ndimage as sn
+import scipy.signal
 import picamera
 
+import actuator
+import metrics
+import tiles
 
-# I2C
-bus = smbus.SMBus(1)
+
+# I2C. Moves are written from the actuator's own thread.
 address = 0x04
+servo = actuator.Actuator(actuator.I2CBus(1, address))
 
 timeout = 100
 secperdeg = 0.005
+calibration_time = 2 # seconds given to camera to adjust exposure and awb
+clock = time.time # timestamps for settling and stats, replaced by replay.py
 res = (640, 480)
+full_range = 180 # degrees the servo can travel
 #import sys
 #res = (int(sys.argv[1]), int(sys.argv[2]))
 
-def move(angle):
+def move(angle, callback=None, block=True):
     """Communicate an angle to to the Arduino using I2C which will in turn
     move the servo to the position specified.
+
+    With block=False, return as soon as the move is queued on the actuator
+    and call callback(angle, timestamp) once it has been written.
     """
-    #Since the servo's range of motion is less than 180 degrees, we can always
-    # contain the data within one byte.
-    bus.write_byte(address, angle)
+    servo.move(angle, callback)
+    if block:
+        servo.wait()
+
+def origin(angle):
+    """Return the angle the servo is moving to angle from, for Sweeper's
+    start argument: the last angle written, or before the first write, when
+    the servo could be anywhere, the end of its range furthest from angle.
+    """
+    if servo.angle is not None:
+        return servo.angle
+    return 0 if angle > full_range / 2 else full_range
+
+def _focus_measure_worker(conn, shared, index, shape, masks, metric):
+    """Loop in a child process, calculating focus measures for images in a
+    slot of shared memory at whichever pyramid level the parent asks for
+    over conn.
+    """
+    image = np.frombuffer(shared, dtype=np.uint8).reshape(
+            (-1,) + shape)[index]
+    pyramid = tiles.Pyramid(shape, len(masks) - 1)
+    focus_measure = metrics.get(metric)
+    while True:
+        level = conn.recv()
+        if level is None:
+            break
+        conn.send(focus_measure(pyramid.build(image, level), masks[level]))
 
 class FocusMeasureProcessor(threading.Thread):
     """This class is a thread that receives images and calculates focus
     measures for them.
+
+    Images are copied into the processor's own preallocated image array by
+    its owner. The processor is out of the owner's pool until it is done
+    with an image, so the image is never overwritten mid-calculation.
+
+    The focus measure is looked up by name in the metrics module. It is
+    evaluated on the image halved level times, where level is set by the
+    owner along with angle_index. masks holds the mask for each level, or
+    None to leave that level unmasked.
     """
-    def __init__(self, owner, resolution, mask=None):
+    def __init__(self, owner, image, masks=(None,), metric='laplace'):
         # Set up thread.
         super(FocusMeasureProcessor, self).__init__()
         self.event = threading.Event()
         self.terminated = False
         self.owner = owner
 
-        # Declare members required for image processing (is this necessary?).
-        self.image = np.empty(resolution[::-1], dtype=np.uint8)
+        # Declare members required for image processing.
+        self.image = image
         self.angle_index = -1
-
-        # Default mask is all 1s (unmasked).
-        if mask is None:
-            self.mask = np.ones(resolution[::-1], dtype=bool)
-        else:
-            self.mask = mask
+        self.level = 0
+        self.focus_measure = metrics.get(metric)
+        self.pyramid = tiles.Pyramid(image.shape, len(masks) - 1)
+        self.masks = masks
 
         # Start thread.
         self.start()
@@ -61,63 +102,456 @@ class FocusMeasureProcessor(threading.Thread):
         while not self.terminated:
             # Wait for an image to be received.
             if self.event.wait(1):
-                # Calculate focus measure, applying mask after laplace
-                # transform.
-                image_laplace = sn.filters.laplace(self.image)
-                focus_measure = np.mean(image_laplace[self.mask])
+                # Woken up by flush() rather than by a new image.
+                if self.terminated:
+                    break
 
-                # Write to corresponding position in owner's focus_measure
-                # array.
-                self.owner.focus_measures[self.angle_index] = focus_measure
+                # Hand the image on to the owner's sink, if any, while it is
+                # still ours, then write to corresponding position in
+                # owner's focus_measure array.
+                focus_measure = self.measure()
+                if self.owner.sink is not None:
+                    self.owner.sink(
+                            self.owner.angles[self.angle_index], self.image,
+                            focus_measure)
+                self.owner.record(self.angle_index, focus_measure)
 
                 # Done. Reset event and return to pool.
                 self.event.clear()
                 with self.owner.lock:
                     self.owner.pool.append(self)
 
+    def measure(self):
+        return self.focus_measure(
+                self.pyramid.build(self.image, self.level),
+                self.masks[self.level])
+
+class FocusMeasureProcess(FocusMeasureProcessor):
+    """This class is a FocusMeasureProcessor that hands the calculation to a
+    child process so that processors aren't held back by the GIL.
+
+    The image slot lives in shared memory, so only a wake-up message and the
+    resulting focus measure are sent down the pipe.
+    """
+    def __init__(self, owner, image, masks, metric, shared, index):
+        # Start the worker before the thread so that nothing can be sent to
+        # it too early.
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+                target=_focus_measure_worker,
+                args=(child_conn, shared, index, image.shape, masks, metric))
+        self.process.daemon = True
+        self.process.start()
+        super(FocusMeasureProcess, self).__init__(
+                owner, image, masks, metric)
+
+    def run(self):
+        super(FocusMeasureProcess, self).run()
+
+        # Terminated. Stop the worker too.
+        self.conn.send(None)
+        self.process.join()
+
+    def measure(self):
+        self.conn.send(self.level)
+        return self.conn.recv()
+
+class SweepStats(object):
+    """This class collects statistics about a sweep, to find out whether it
+    is limited by the camera, the servo or the CPU.
+
+    Counts frames received, frames skipped while the servo settled and
+    frames skipped because no processor was free. Per angle, it records when
+    the servo was told to move there (angle_times), when the move was
+    written to the bus (moved_times), how long it then took to settle, and
+    when its frame was dispatched to a processor and its result came back.
+    timed_out is set if the sweep didn't finish in time.
+
+    If a profiler is given it is called as profiler(event, angle_index,
+    timestamp) for every 'move', 'moved', 'skip_settle', 'skip_busy',
+    'dispatch' and 'result' event.
+    """
+    def __init__(self, n, profiler=None):
+        self.received = 0
+        self.skipped_settle = 0
+        self.skipped_busy = 0
+        self.angle_times = [None] * n
+        self.moved_times = [None] * n
+        self.settle_times = [None] * n
+        self.dispatch_times = [None] * n
+        self.result_times = [None] * n
+        self.timed_out = False
+        self.profiler = profiler
+
+    def event(self, name, angle_index, timestamp=None):
+        """Record an event and pass it on to the profiler."""
+        if timestamp is None:
+            timestamp = clock()
+        if name == 'move':
+            self.angle_times[angle_index] = timestamp
+        elif name == 'moved':
+            self.moved_times[angle_index] = timestamp
+        elif name == 'skip_settle':
+            self.skipped_settle += 1
+        elif name == 'skip_busy':
+            self.skipped_busy += 1
+        elif name == 'dispatch':
+            self.dispatch_times[angle_index] = timestamp
+        elif name == 'result':
+            self.result_times[angle_index] = timestamp
+        if self.profiler is not None:
+            self.profiler(name, angle_index, timestamp)
+
+    def latencies(self):
+        """Return the dispatch-to-result latency of every processed frame."""
+        return [
+                result - dispatch
+                for dispatch, result in zip(
+                    self.dispatch_times, self.result_times)
+                if dispatch is not None and result is not None]
+
+    def histogram(self, bins=10):
+        """Return a histogram of latencies as (counts, bin edges)."""
+        return np.histogram(self.latencies(), bins)
+
+    def report(self):
+        """Return a human-readable summary."""
+        lines = [
+                'frames received: %d' % self.received,
+                'skipped for settling: %d' % self.skipped_settle,
+                'skipped for busy pool: %d' % self.skipped_busy,
+                'timed out: %s' % self.timed_out]
+        latencies = self.latencies()
+        if latencies:
+            counts, edges = self.histogram()
+            lines.append('latency (ms):')
+            for count, lo, hi in zip(counts, edges, edges[1:]):
+                lines.append('  %7.2f-%7.2f %d' % (
+                    lo * 1000, hi * 1000, count))
+        return '\n'.join(lines)
+
 class Sweeper(object):
     """This class sweeps the servo through a range of positions, pulling
     frames from a video stream at appropriate times and delegating them
     amongst processing threads to construct an array of focus_measures for
     each position.
+
+    With backend='process' each processing thread hands its calculations to
+    a worker process, with frames passed through shared memory. metric names
+    the focus measure to use from the metrics module. mask may be a boolean
+    array of the frame's shape or a metrics.Roi.
+
+    Frames can be measured at lower resolution than they are captured at.
+    With depth > 0 processors can halve each frame up to depth times with
+    integer 2x2 averaging, and level (which reset() can change between
+    sweeps) sets how many times they do. A boolean mask is halved along with
+    the frames; otherwise mask must be a list of Rois, one for each level
+    (see make_mask.compile_mask).
+
+    If stop_drop is given, the sweep stops early once the median filtered
+    focus curve has a clear maximum and has since fallen by stop_drop times
+    its rise to that maximum. peak_index is then set to the maximum's index.
+
+    Moves are queued on the servo actuator so that frames keep flowing
+    while they are written. By default a frame is accepted a fixed secperdeg
+    per degree after each move has been written. If settle_threshold is
+    given, a frame is instead accepted once thumbnails (every settle_step-th
+    pixel) of consecutive frames since the move differ by less than
+    settle_threshold grey levels on average, or settle_timeout seconds after
+    the move. If a move can't be written, the sweep is given up: done and
+    failed are set, and the actuator keeps the error for servo.wait() to
+    raise.
+
+    Statistics for the current sweep are collected in stats, a SweepStats
+    which is passed profiler.
+
+    If sink is given it is called as sink(angle, image, focus_measure) for
+    every frame processed, from the processor's thread, e.g. to build a
+    focal stack with focal_stack.FocalStacker.sink. image is only valid
+    until sink returns.
+
+    The servo is taken to be at angles[0] already, unless start is given:
+    the angle it was last moved to angles[0] from (see origin()). The first
+    frame then waits for the servo to settle after that move, as for any
+    other.
     """
-    def __init__(self, angles, resolution, mask=None, threads=4):
+    def __init__(self, angles, resolution, mask=None, threads=4,
+            backend='thread', metric='laplace', stop_drop=None,
+            filter_size=3, settle_threshold=None, settle_timeout=0.5,
+            settle_step=8, profiler=None, depth=0, level=0, sink=None,
+            start=None):
         # Flag for communicating with 'outsiders' that sweeping is done.
         self.done = False
+        self.failed = False
 
         # Construct a pool of processors along with a lock to control access
         # between threads.
         self.threads = threads
         self.resolution = resolution
-        self.pixels = np.prod(resolution)
         self.lock = threading.Lock()
-        self.pool = [
-                FocusMeasureProcessor(self, resolution, mask) \
-                for i in range(threads)]
-        self.processor = None
+
+        # picamera pads each row of a YUV frame to a multiple of 32 bytes.
+        self.stride = (resolution[0] + 31) // 32 * 32
+
+        # Compile the mask once for each pyramid level so that processors
+        # only evaluate focus measures over its bounding box.
+        if level > depth:
+            raise ValueError('level %d is deeper than depth %d' % (
+                level, depth))
+        if mask is None:
+            masks = [None] * (depth + 1)
+        elif isinstance(mask, (list, tuple)):
+            if len(mask) != depth + 1:
+                raise ValueError('expected a Roi for each of %d levels' % (
+                    depth + 1))
+            masks = list(mask)
+        elif isinstance(mask, metrics.Roi):
+            if depth > 0:
+                raise ValueError('a pyramid needs a boolean mask, not a Roi')
+            masks = [mask]
+        else:
+            masks = []
+            for _ in range(depth + 1):
+                masks.append(metrics.Roi(mask))
+                mask = tiles.decimate_mask(mask)
+        self.depth = depth
+        self.level = level
+        self.sink = sink
+
+        # Preallocate a ring of luma slots, one per processor, so that frames
+        # are copied exactly once and nothing is allocated per frame.
+        shape = (threads, resolution[1], resolution[0])
+        if backend == 'process':
+            shared = multiprocessing.RawArray('B', int(np.prod(shape)))
+            self.slots = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+            self.pool = [
+                    FocusMeasureProcess(
+                        self, self.slots[i], masks, metric, shared, i) \
+                    for i in range(threads)]
+        elif backend == 'thread':
+            self.slots = np.empty(shape, dtype=np.uint8)
+            self.pool = [
+                    FocusMeasureProcessor(self, self.slots[i], masks, metric) \
+                    for i in range(threads)]
+        else:
+            raise ValueError('unknown backend %r' % backend)
+        self.processor = self.pool.pop()
 
         # Sweeper-specific members
         self.angles = angles
         self.angle_index = 0
         self.focus_measures = [None] * len(angles)
 
+        # Keep count of servo moves and frames received so that different
+        # search strategies can be compared.
+        self.moves = 0
+        self.frames = 0
+        self.stats = SweepStats(len(angles), profiler)
+
+        # Online peak detection. filtered holds the median filtered curve for
+        # as far as the focus measures are known without gaps.
+        self.stop_drop = stop_drop
+        self.filter_size = filter_size
+        self.filtered = []
+        self.peak_index = None
+
         # We don't want to process a new frame until the servo has moved to
         # the correct position, so use this parameter to stall.
-        self.next_frame = time.time() # servo is already in position
+        self.next_frame = clock() # servo is already in position
+
+        # Settle detection. move_time is None when the servo is in position
+        # and pending holds the number of a move the actuator has yet to
+        # write.
+        self.pending = None
+        self.settle_threshold = settle_threshold
+        self.settle_timeout = settle_timeout
+        self.settle_step = settle_step
+        self.move_time = None
+
+        # The servo may still be on its way to the first angle, from start.
+        # The actuator knows when the move was written.
+        moved = self.next_frame
+        if start is not None and servo.move_time is not None:
+            moved = self.move_time = servo.move_time
+            self.next_frame = moved + secperdeg * abs(angles[0] - start)
+        self.stats.event('move', 0, moved)
+        self.stats.event('moved', 0, moved)
+        thumb_shape = (
+                (resolution[1] + settle_step - 1) // settle_step,
+                (resolution[0] + settle_step - 1) // settle_step)
+        self.thumbs = np.zeros((2,) + thumb_shape, dtype=np.int16)
+        self.thumb_diff = np.empty(thumb_shape, dtype=np.int16)
+        self.thumb_count = 0 # thumbnails taken since the last move
+
+    def reset(self, angles, level=None, hold=False):
+        """Start a new sweep through angles without stopping the recording,
+        optionally at a different pyramid level.
+
+        With hold=True the servo is taken to be at angles[0] already, as for
+        the first sweep, and no move is sent for it, e.g. to measure again
+        at the angle the servo was left at.
+
+        Only call this once every focus measure from the previous sweep has
+        come in, as processors write their results by index.
+        """
+        if level is not None:
+            if level > self.depth:
+                raise ValueError('level %d is deeper than depth %d' % (
+                    level, self.depth))
+            self.level = level
+        with self.lock:
+            previous = self.angles[self.angle_index]
+            self.angles = angles
+            self.angle_index = 0
+            self.focus_measures = [None] * len(angles)
+            self.filtered = []
+            self.peak_index = None
+            self.stats = SweepStats(len(angles), self.stats.profiler)
+
+            # Unlike the first sweep, the servo isn't already in position.
+            if hold:
+                now = clock()
+                self.stats.event('move', 0, now)
+                self.stats.event('moved', 0, now)
+            else:
+                self.move_to(0, abs(angles[0] - previous))
+            self.done = False
+            self.failed = False
+
+    def record(self, angle_index, focus_measure):
+        """Store a focus measure. Called by processors."""
+        self.focus_measures[angle_index] = focus_measure
+        self.stats.event('result', angle_index)
+        if self.stop_drop is not None:
+            with self.lock:
+                self.detect_peak()
+
+    def detect_peak(self):
+        """Extend the median filtered curve as far as the focus measures
+        allow and stop the sweep if it has fallen far enough past a clear
+        maximum. Call with the lock held.
+        """
+        if self.done:
+            return
+
+        # Each filtered value needs its neighbours either side, apart from
+        # at the start where the window is cut short.
+        half = self.filter_size // 2
+        fms = self.focus_measures
+        while len(self.filtered) + half < len(fms):
+            i = len(self.filtered)
+            window = fms[max(0, i - half) : i + half + 1]
+            if None in window:
+                break
+            self.filtered.append(np.median(window))
+
+        # A clear maximum is one which the curve rose to and has since
+        # fallen back from.
+        if len(self.filtered) < 2:
+            return
+        peak = int(np.argmax(self.filtered))
+        rise = self.filtered[peak] - min(self.filtered[:peak + 1])
+        fall = self.filtered[peak] - self.filtered[-1]
+        if peak > 0 and rise > 0 and fall >= self.stop_drop * rise:
+            self.peak_index = peak
+            self.done = True
+
+    def idle(self):
+        """Return True if no processor is busy, i.e. all focus measures for
+        the frames taken so far are in.
+        """
+        with self.lock:
+            held = self.processor is not None
+            return len(self.pool) + held == self.threads
+
+    def move_to(self, angle_index, degrees):
+        """Ask the actuator to move the servo to angles[angle_index], degrees
+        away, without waiting. Frames aren't accepted until the move has
+        been written and the servo has settled.
+        """
+        self.moves += 1
+        self.pending = self.moves
+        self.move_time = clock()
+        self.thumb_count = 0
+        self.stats.event('move', angle_index, self.move_time)
+        move(
+                self.angles[angle_index],
+                functools.partial(
+                    self.moved, self.pending, angle_index, degrees),
+                block=False)
+
+    def moved(self, move_number, angle_index, degrees, angle, timestamp):
+        """Note that the servo was told to move by degrees at timestamp.
+        Called by the actuator once the move has been written.
+        """
+        if move_number != self.pending:
+            return # superseded by a later move
+        self.move_time = timestamp
+        self.next_frame = timestamp + secperdeg * degrees
+        self.stats.event('moved', angle_index, timestamp)
+        self.pending = None
+
+    def settled(self, luma):
+        """Return True if the servo has settled and the frame whose Y plane
+        is luma can be used.
+        """
+        now = clock()
+        if self.pending is not None:
+            if servo.error is not None:
+                # The write failed, so the move will never be made.
+                self.failed = self.done = True
+            return False # not written to the bus yet
+        if self.move_time is None:
+            return True
+
+        if self.settle_threshold is None:
+            # Fixed delay after the move.
+            settled = now > self.next_frame
+        else:
+            # Compare a thumbnail of this frame with the previous one, as
+            # long as both were taken after the move.
+            step = self.settle_step
+            thumb = self.thumbs[self.thumb_count % 2]
+            np.copyto(thumb, luma[::step, ::step])
+            self.thumb_count += 1
+            settled = now - self.move_time > self.settle_timeout
+            if self.thumb_count > 1 and not settled:
+                np.subtract(
+                        thumb, self.thumbs[self.thumb_count % 2],
+                        out=self.thumb_diff)
+                np.abs(self.thumb_diff, out=self.thumb_diff)
+                settled = np.mean(self.thumb_diff) < self.settle_threshold
+
+        if settled:
+            self.stats.settle_times[self.angle_index] = now - self.move_time
+            self.move_time = None
+        return settled
 
     def write(self, buf):
         # This is called for every frame of video capture.
+        self.frames += 1
+        if self.done:
+            return
+        self.stats.received += 1
+
+        # Y plane of the frame, minus row padding. buf belongs to picamera
+        # and may be reused once we return.
+        luma = np.frombuffer(
+                buf, dtype=np.uint8,
+                count=self.stride * self.resolution[1]).reshape(
+                self.resolution[1], self.stride)[:, :self.resolution[0]]
+
         # We are only interested in the frames where the servo is not moving
-        if time.time() > self.next_frame:
+        if self.settled(luma):
             # Set the current processor going.
             if self.processor:
-                # Send frame to processor
-                self.processor.image = np.frombuffer(
-                        buf, dtype=np.uint8, count=self.pixels).reshape(
-                        self.resolution[1], self.resolution[0])
+                # Copy the frame into the processor's slot.
+                np.copyto(self.processor.image, luma)
                 self.processor.angle_index = self.angle_index
+                self.processor.level = self.level
 
                 # Signal to start processing
+                self.stats.event('dispatch', self.angle_index)
                 self.processor.event.set()
 
                 # Move servo to next position - unless we are at the end of
@@ -126,16 +560,12 @@ class Sweeper(object):
                     self.done = True
                 else:
                     self.angle_index += 1
-                    move(self.angles[self.angle_index])
-
-                    # Allow time for movement to complete before processing
-                    # next frame:
-                    # 0.01s per degree moved.
-                    self.next_frame = (
-                            time.time()
-                            + secperdeg
-                            * (self.angles[self.angle_index]
-                            - self.angles[self.angle_index - 1]))
+                    self.move_to(
+                            self.angle_index,
+                            abs(self.angles[self.angle_index]
+                                - self.angles[self.angle_index - 1]))
+            else:
+                self.stats.event('skip_busy', self.angle_index)
 
             # Attempt to grab a spare processor for the next frame.
             with self.lock:
@@ -147,6 +577,8 @@ class Sweeper(object):
                     # a processor becomes available. In the meantime no move()
                     # calls are made so nothing is lost (except time).
                     self.processor = None
+        else:
+            self.stats.event('skip_settle', self.angle_index)
 
     def flush(self):
         # Called when video recording ends.
@@ -164,22 +596,16 @@ class Sweeper(object):
                 try:
                     proc = self.pool.pop()
                     proc.terminated = True
+                    proc.event.set()
                     proc.join()
                 except IndexError:
                     pass # pool empty
 
-def sweep(angles, camera, resolution, framerate = 30):
-    """Sweep the servo through a range of angles, evaluating a focus measure
-    for each one from images captured at the given resolution.
-
-    Aim for moving through the array of angles at a rate specified by
-    framerate parameter.
-
-    Return an array of focus measures corresponding to each position.
+def calibrate(camera, resolution):
+    """Set the camera's resolution, let it adjust to light levels and then
+    fix its exposure and white balance so that focus measures taken from
+    different frames are comparable.
     """
-    # Move servo to starting position.
-    move(angles[0])
-
     # Set camera resolution.
     camera.sensor_mode = 4 # full field of view capture
     camera.resolution = resolution
@@ -188,7 +614,7 @@ def sweep(angles, camera, resolution, framerate = 30):
     camera.start_preview()
     camera.exposure_mode = 'auto'
     camera.awb_mode = 'auto'
-    time.sleep(2)
+    time.sleep(calibration_time)
 
     # Now that camera is calibrated, fix its settings.
     # Shutter speed
@@ -200,37 +626,416 @@ def sweep(angles, camera, resolution, framerate = 30):
     camera.awb_mode = 'off'
     camera.awb_gains = g
 
+def sweep(angles, camera, resolution, framerate = 30, stats=False,
+        **kwargs):
+    """Sweep the servo through a range of angles, evaluating a focus measure
+    for each one from images captured at the given resolution.
+
+    Aim for moving through the array of angles at a rate specified by
+    framerate parameter. Remaining keyword arguments (threads, backend,
+    metric, stop_drop, settle_threshold, profiler...) are passed on to
+    Sweeper.
+
+    Return an array of focus measures corresponding to each position. If
+    the sweep stopped early at a peak, the servo is moved to the peak and
+    only the focus measures taken are returned. If stats is True, return
+    the sweep's SweepStats as well.
+    """
+    # Move servo to starting position while the camera calibrates.
+    previous = origin(angles[0])
+    move(angles[0])
+    calibrate(camera, resolution)
+
     # Start a video recording which will allow us to rapidly capture and
     # process frames.
     camera.framerate = framerate
-    sweeper = Sweeper(angles, resolution)
+    sweeper = Sweeper(angles, resolution, start=previous, **kwargs)
     camera.start_recording(sweeper, 'yuv')
 
     # Wait until sweeper is finished.
     start = time.time()
     while time.time() - start < timeout and not sweeper.done:
         camera.wait_recording(1.0 / framerate)
+    sweeper.stats.timed_out = not sweeper.done
     camera.stop_recording()
     camera.stop_preview()
+    servo.wait() # raises the error if a move failed
 
     # Sweep finished. Return calculated focus measures.
-    return sweeper.focus_measures
+    fms = sweeper.focus_measures
+    if sweeper.peak_index is not None:
+        move(angles[sweeper.peak_index])
+        while fms[-1] is None:
+            fms.pop()
+    if stats:
+        return fms, sweeper.stats
+    return fms
+
+def _ends(angles, reverse):
+    """Return the first and last angle of a sweep through angles."""
+    if reverse:
+        return angles[-1], angles[0]
+    return angles[0], angles[-1]
+
+def travel(sweeps, order, start=None):
+    """Return the degrees the servo travels between the sweeps in order, a
+    list of (index, reverse) pairs, including the move to the first from
+    start if given.
+    """
+    total = 0
+    position = start
+    for index, reverse in order:
+        first, last = _ends(sweeps[index], reverse)
+        if position is not None:
+            total += abs(first - position)
+        position = last
+    return total
+
+def plan(sweeps, start=None, exact_limit=10):
+    """Choose the order and direction in which to run several sweeps, each a
+    list of angles, so that the servo travels as little as possible between
+    them, starting from the angle start (default: the servo's current
+    angle).
+
+    A sweep covers the same angles whichever way it runs, so back to back
+    sweeps over the same range alternate direction rather than each paying
+    a return trip. Up to exact_limit sweeps are planned exactly, by dynamic
+    programming over the subsets already swept; beyond that the next sweep
+    is whichever has an end nearest the servo. Between equally short plans,
+    or equally near sweeps, the earlier sweeps given go first and run
+    forwards.
+
+    Return a list of (index, reverse) pairs in the order to run them.
+    """
+    if start is None:
+        start = servo.angle
+    sweeps = [list(angles) for angles in sweeps]
+    n = len(sweeps)
+
+    def distance(position, index, reverse):
+        if position is None:
+            return 0
+        return abs(_ends(sweeps[index], reverse)[0] - position)
+
+    if n > exact_limit:
+        order = []
+        remaining = list(range(n))
+        position = start
+        while remaining:
+            index, reverse = min(
+                    ((i, r) for i in remaining for r in (False, True)),
+                    key=lambda choice: distance(position, *choice))
+            remaining.remove(index)
+            order.append((index, reverse))
+            position = _ends(sweeps[index], reverse)[1]
+        return order
+
+    # best maps (swept subset, last index, reverse) to (travel, order).
+    # Ties go to the order which comes first, comparing (index, reverse)
+    # pairs, so equally short plans keep as close to the order given as they
+    # can, forwards where there's a choice.
+    best = {}
+    for i in range(n):
+        for r in (False, True):
+            best[(1 << i, i, r)] = (distance(start, i, r), [(i, r)])
+    for mask in range(1, 1 << n):
+        for i in range(n):
+            for r in (False, True):
+                if (mask, i, r) not in best:
+                    continue
+                cost, order = best[(mask, i, r)]
+                last = _ends(sweeps[i], r)[1]
+                for j in range(n):
+                    if mask & (1 << j):
+                        continue
+                    for r2 in (False, True):
+                        key = (mask | (1 << j), j, r2)
+                        candidate = (
+                                cost + distance(last, j, r2),
+                                order + [(j, r2)])
+                        if key not in best or candidate < best[key]:
+                            best[key] = candidate
+    full = (1 << n) - 1
+    finished = [
+            best[(full, i, r)] for i in range(n) for r in (False, True)
+            if (full, i, r) in best]
+    return min(finished)[1] if finished else []
+
+def sweep_many(runs, camera, framerate=30, **kwargs):
+    """Run several sweeps, each given as (angles, resolution), in the order
+    and directions plan() chooses. Remaining keyword arguments are passed
+    on to Sweeper.
+
+    Return the focus measures of each sweep in the order runs were given,
+    each in the order of its angles however it was swept. Angles not
+    reached because a sweep stopped early are None.
+    """
+    results = [None] * len(runs)
+    for index, reverse in plan([angles for angles, _ in runs]):
+        angles, resolution = runs[index]
+        angles = list(angles)
+        if reverse:
+            angles.reverse()
+        fms = sweep(angles, camera, resolution, framerate, **kwargs)
+        fms = fms + [None] * (len(angles) - len(fms))
+        if reverse:
+            fms.reverse()
+        results[index] = fms
+    return results
+
+def _fit_quadratic(x, y, weights=None):
+    """Return the coefficients (a, b, c) of the weighted least squares fit
+    a x^2 + b x + c to the points (x, y), and its R squared.
+    """
+    if weights is None:
+        weights = np.ones(len(x))
+    coeffs = np.polyfit(x, y, 2, w=np.sqrt(weights))
+    mean = np.average(y, weights=weights)
+    total = np.sum(weights * (y - mean) ** 2)
+    residual = np.sum(weights * (y - np.polyval(coeffs, x)) ** 2)
+    r2 = 1 - residual / total if total > 0 else 0.0
+    return coeffs, r2
+
+def estimate_peak(angles, fms, method='parabola', width=None,
+        iterations=10):
+    """Estimate the angle of the maximum of a focus curve to a fraction of
+    the spacing of angles, so that sweeps can take coarse steps.
+
+    The highest point of the median filtered curve is found as in
+    autofocus.py, and the highest raw focus measure next to it taken as the
+    centre, so that the filter's flattening of a sharp peak doesn't pull the
+    fit off to one side. A curve is then fitted to the focus measures within
+    width positions either side of the centre. method is:
+
+        parabola    least squares quadratic
+        gaussian    quadratic fitted to the log of the focus measures, i.e.
+                    a Gaussian, which suits the tails of a peak better
+        robust      quadratic fitted by iteratively reweighted least squares
+                    (Tukey's biweight), so that a stray measure, e.g. from a
+                    frame taken before the servo settled, is left out
+
+    width defaults to 2, or 4 for robust: with only 5 points, 3 of them
+    needed for the fit, one stray measure can't be told from the peak.
+
+    Return (angle, confidence). confidence is the fit's R squared, between
+    0 and 1. If there are too few points or the fitted curve has no maximum
+    between them, the highest point's own angle is returned with confidence
+    0. Focus measures of None or -inf (never taken) are ignored.
+    """
+    known = [
+            i for i, fm in enumerate(fms)
+            if fm is not None and np.isfinite(fm)]
+    if not known:
+        raise ValueError('no focus measures to estimate a peak from')
+    x = np.array([angles[i] for i in known], dtype=np.float64)
+    y = np.array([fms[i] for i in known], dtype=np.float64)
+    if width is None:
+        width = 4 if method == 'robust' else 2
+    filtered = y
+    if len(y) >= 3:
+        filtered = scipy.signal.medfilt(y)
+    peak = int(np.argmax(filtered))
+    # The raw maximum within the filter's reach of the filtered one.
+    near = max(0, peak - 1)
+    peak = near + int(np.argmax(y[near:peak + 2]))
+    lo = max(0, peak - width)
+    x = x[lo:peak + width + 1] - x[peak] # centred for conditioning
+    y = y[lo:peak + width + 1]
+    if len(x) < 3:
+        return angles[known[peak]], 0.0
+
+    if method == 'gaussian' and np.all(y > 0):
+        coeffs, r2 = _fit_quadratic(x, np.log(y))
+    elif method == 'robust':
+        weights = np.ones(len(x))
+        for _ in range(iterations):
+            coeffs, r2 = _fit_quadratic(x, y, weights)
+            residuals = y - np.polyval(coeffs, x)
+            # 4.685 times the MAD estimate of the residuals' spread
+            scale = 4.685 * 1.4826 * np.median(np.abs(residuals))
+            if scale == 0:
+                break
+            u = np.minimum(np.abs(residuals) / scale, 1)
+            weights = (1 - u ** 2) ** 2
+            if np.count_nonzero(weights) < 3:
+                break
+    elif method in ('parabola', 'gaussian'):
+        coeffs, r2 = _fit_quadratic(x, y)
+    else:
+        raise ValueError('unknown peak estimation method %r' % method)
+
+    a, b = coeffs[:2]
+    vertex = -b / (2 * a) if a < 0 else None
+    if vertex is None or not x.min() <= vertex <= x.max():
+        return angles[known[peak]], 0.0
+    return angles[known[peak]] + vertex, float(np.clip(r2, 0, 1))
+
+def search(angles, camera, resolution, steps=(16, 4, 1), framerate=30,
+        levels=None, **kwargs):
+    """Find the angle with the maximum focus measure using a coarse-to-fine
+    search rather than sweeping every angle.
+
+    The first level sweeps every steps[0]th angle across the whole range.
+    Each following level sweeps every steps[i]th angle within steps[i-1]
+    positions either side of the previous level's peak. The recording is
+    kept running between levels. The final level's curve is median filtered
+    as in autofocus.py before taking its maximum. Remaining keyword
+    arguments are passed on to Sweeper.
+
+    levels optionally gives the pyramid level to measure each level of the
+    search at, e.g. (2, 1, 0) measures the first level's frames at quarter
+    resolution and only the final neighbourhood of the peak at full
+    resolution.
+
+    Move to the best angle found and return (angle, moves, frames), where
+    moves and frames count the servo moves made and frames received.
+    """
+    # Indices into angles for the first level.
+    indices = list(range(0, len(angles), steps[0]))
+
+    # Move servo to starting position while the camera calibrates.
+    previous = origin(angles[indices[0]])
+    move(angles[indices[0]])
+    calibrate(camera, resolution)
+
+    camera.framerate = framerate
+    if levels is None:
+        levels = [0] * len(steps)
+    sweeper = Sweeper(
+            [angles[i] for i in indices], resolution,
+            depth=max(levels), level=levels[0], start=previous, **kwargs)
+    sweeper.moves = 1
+    camera.start_recording(sweeper, 'yuv')
+
+    start = time.time()
+    for level, step in enumerate(steps):
+        if level > 0:
+            # Refine around the previous level's peak.
+            lo = max(0, peak - steps[level - 1])
+            hi = min(len(angles) - 1, peak + steps[level - 1])
+            indices = list(range(lo, hi + 1, step))
+            sweeper.reset([angles[i] for i in indices], levels[level])
+
+        # Wait for the sweep and all of its focus measures to complete.
+        while time.time() - start < timeout and not (
+                sweeper.done and sweeper.idle()):
+            camera.wait_recording(1.0 / framerate)
+        if sweeper.failed:
+            break
+
+        # Angles not reached before a timeout can't be the peak.
+        fms = [-np.inf if fm is None else fm for fm in sweeper.focus_measures]
+        if step == 1 and len(fms) >= 3:
+            fms = scipy.signal.medfilt(fms).tolist()
+        peak = indices[fms.index(max(fms))]
+        if not sweeper.done:
+            break # timed out
+    camera.stop_recording()
+    camera.stop_preview()
+    servo.wait() # raises the error if a move failed
+
+    move(angles[peak])
+    return angles[peak], sweeper.moves + 1, sweeper.frames
+
+def pyramid_levels(steps):
+    """Return pyramid levels for a coarse-to-fine search with steps which
+    halve the resolution once per level above the last, finishing at full
+    resolution.
+    """
+    return list(range(len(steps) - 1, -1, -1))
+
+def refocus(angles, camera, resolution, centre, width=8, framerate=30,
+        min_rise=0.05, **kwargs):
+    """Find the angle with the maximum focus measure, starting near the
+    index centre into angles, e.g. where the sample was last in focus.
+
+    Every angle within width positions of centre is swept first. Unless the
+    median filtered curve falls away from its maximum by at least min_rise
+    times the maximum at both ends of what has been swept, the peak may lie
+    beyond, so the sweep is extended on the higher side by twice as much as
+    last time. This repeats until a clear peak is found inside or the ends
+    of angles are reached. Remaining keyword arguments are passed on to
+    Sweeper.
+
+    Move to the best angle found and return (angle, curve, moves, frames),
+    where curve is a list of (angle, focus measure) pairs for every angle
+    swept, in order.
+    """
+    lo = max(0, centre - width)
+    hi = min(len(angles) - 1, centre + width)
+    indices = list(range(lo, hi + 1))
+
+    # Move servo to starting position while the camera calibrates.
+    previous = origin(angles[lo])
+    move(angles[lo])
+    calibrate(camera, resolution)
+
+    camera.framerate = framerate
+    sweeper = Sweeper(
+            [angles[i] for i in indices], resolution, start=previous,
+            **kwargs)
+    sweeper.moves = 1
+    camera.start_recording(sweeper, 'yuv')
+
+    measured = {}
+    start = time.time()
+    while True:
+        # Wait for the sweep and all of its focus measures to complete.
+        while time.time() - start < timeout and not (
+                sweeper.done and sweeper.idle()):
+            camera.wait_recording(1.0 / framerate)
+        if sweeper.failed:
+            break
+        for i, fm in zip(indices, sweeper.focus_measures):
+            # Angles not reached before a timeout can't be the peak.
+            measured[i] = -np.inf if fm is None else fm
+        if not sweeper.done:
+            break # timed out
+
+        # Is there a clear peak inside what has been swept so far?
+        fms = [measured[i] for i in range(lo, hi + 1)]
+        if len(fms) >= 3:
+            fms = scipy.signal.medfilt(fms).tolist()
+        clear = max(fms) * (1 - min_rise)
+        open_lo = fms[0] > clear and lo > 0
+        open_hi = fms[-1] > clear and hi < len(angles) - 1
+        width *= 2
+        if open_lo and not (open_hi and fms[-1] > fms[0]):
+            indices = list(range(max(0, lo - width), lo))
+        elif open_hi:
+            indices = list(range(hi + 1, min(len(angles), hi + 1 + width)))
+        else:
+            break
+
+        # Extend the sweep, always in increasing angle order.
+        lo = min(lo, indices[0])
+        hi = max(hi, indices[-1])
+        sweeper.reset([angles[i] for i in indices])
+    camera.stop_recording()
+    camera.stop_preview()
+    servo.wait() # raises the error if a move failed
+
+    fms = [measured[i] for i in range(lo, hi + 1)]
+    if len(fms) >= 3:
+        fms = scipy.signal.medfilt(fms).tolist()
+    peak = lo + fms.index(max(fms))
+    move(angles[peak])
+    curve = [(angles[i], measured[i]) for i in range(lo, hi + 1)]
+    return angles[peak], curve, sweeper.moves + 1, sweeper.frames
 
 def main():
+    # Sweep at each resolution in turn, with consecutive sweeps running in
+    # opposite directions so that the servo never has to return to the start.
+    angles = range(5, 151, 5)
+    runs = [(angles, (64*i, 48*i)) for i in range(1, 9)]
     with picamera.PiCamera() as camera:
-        for i in range(1, 8, 2):
-            print(',angles,')
-            fms = sweep(range(5, 151, 5), camera, (64*i, 48*i))
-            fms -= np.amin(fms, axis=0)
-            fms /= np.amax(fms, axis=0)
-            fms += i - 1
-            print(fms.tolist())
-            print(',angles,')
-            fms = sweep(range(5, 151, 5), camera, (64*(i+1), 48*(i+1)))
-            fms -= np.amin(fms, axis=0)
-            fms /= np.amax(fms, axis=0)
-            fms += i
-            print(fms.tolist())
+        results = sweep_many(runs, camera)
+    for i, fms in enumerate(results):
+        print(',angles,')
+        fms -= np.amin(fms, axis=0)
+        fms /= np.amax(fms, axis=0)
+        fms += i
+        print(fms.tolist())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,173 @@
+"""tiles.py
+
+Block reductions which split an image into square tiles and compute a
+statistic for every tile at once.
+
+Tiles are taken from the top-left corner; any partial tiles along the right
+and bottom edges are left out. Rather than looping over tiles, the image is
+viewed as a (rows, size, cols, size) array and reduced along the two size
+axes in one vectorised pass. Integer images are summed in int64 so that
+uint8 and int16 inputs never need converting to float first.
+
+decimate() and Pyramid halve uint8 images by averaging 2x2 tiles, with
+uint16 arithmetic into preallocated buffers, so that focus measures can be
+evaluated at a fraction of the capture resolution.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+
+def grid_shape(shape, size):
+    """Return the (rows, cols) of whole tiles of size that fit in shape."""
+    return shape[0] // size, shape[1] // size
+
+def tile_view(array, size):
+    """Return a (rows, size, cols, size) view of the whole tiles in a 2D
+    array.
+    """
+    rows, cols = grid_shape(array.shape, size)
+    return array[:rows * size, :cols * size].reshape(rows, size, cols, size)
+
+def _accumulator(array):
+    """Return the dtype to sum array's values in."""
+    if np.issubdtype(array.dtype, np.integer):
+        return np.int64
+    return np.float64
+
+def tile_sum(array, size):
+    """Return the sum of each tile."""
+    return tile_view(array, size).sum(axis=(1, 3), dtype=_accumulator(array))
+
+def tile_mean(array, size):
+    """Return the mean of each tile."""
+    return tile_sum(array, size) / (size * size)
+
+def tile_sum_squares(array, size):
+    """Return the sum of the squares of each tile, without allocating a
+    squared copy of array.
+    """
+    view = tile_view(array, size)
+    return np.einsum('iajb,iajb->ij', view, view, dtype=_accumulator(array))
+
+def tile_var(array, size):
+    """Return the variance of each tile."""
+    n = size * size
+    mean = tile_sum(array, size) / n
+    return tile_sum_squares(array, size) / n - mean * mean
+
+def expand(grid, size, shape=None):
+    """Return a per-pixel array with each tile's value repeated over its
+    tile, optionally padded with zeros to shape.
+    """
+    pixels = np.repeat(np.repeat(grid, size, axis=-2), size, axis=-1)
+    if shape is None:
+        return pixels
+    out = np.zeros(grid.shape[:-2] + tuple(shape), dtype=grid.dtype)
+    out[..., :pixels.shape[-2], :pixels.shape[-1]] = pixels
+    return out
+
+def _decimate(image, out, pairs, acc):
+    """Write the 2x2 tile means of image into out. pairs is a uint16 buffer
+    of shape (rows, 2 * cols) and acc one of out's shape.
+    """
+    rows, cols = out.shape
+    image = image[:rows * 2, :cols * 2]
+    # Sum pairs of whole rows first, which reads memory in order, then pairs
+    # of columns of the half-height result.
+    np.add(image[0::2], image[1::2], out=pairs, dtype=np.uint16)
+    np.add(pairs[:, 0::2], pairs[:, 1::2], out=acc)
+    acc += 2 # round to nearest
+    np.right_shift(acc, 2, out=out, casting='unsafe')
+    return out
+
+def decimate(image):
+    """Return a uint8 image half the size of image in each dimension, each
+    pixel being the rounded mean of a 2x2 tile.
+    """
+    rows, cols = grid_shape(image.shape, 2)
+    return _decimate(
+            image,
+            np.empty((rows, cols), dtype=np.uint8),
+            np.empty((rows, cols * 2), dtype=np.uint16),
+            np.empty((rows, cols), dtype=np.uint16))
+
+def decimate_mask(mask):
+    """Return a boolean mask half the size of mask in each dimension which
+    covers the tiles that are at least half masked in.
+    """
+    return tile_sum(mask.astype(np.uint8), 2) >= 2
+
+class Pyramid(object):
+    """This class builds successively halved copies of images of one shape.
+
+    levels[0] is the image itself and levels[i] is halved i times. Buffers
+    are allocated once, so building a pyramid for each frame allocates
+    nothing.
+    """
+    def __init__(self, shape, depth):
+        self.levels = [None]
+        self._buffers = [None]
+        for _ in range(depth):
+            rows, cols = shape = grid_shape(shape, 2)
+            self.levels.append(np.empty(shape, dtype=np.uint8))
+            self._buffers.append((
+                np.empty((rows, cols * 2), dtype=np.uint16),
+                np.empty(shape, dtype=np.uint16)))
+
+    def build(self, image, depth=None):
+        """Halve image depth times (default: as many as there are levels)
+        and return the level at that depth.
+        """
+        if depth is None:
+            depth = len(self.levels) - 1
+        self.levels[0] = image
+        for i in range(1, depth + 1):
+            _decimate(
+                    self.levels[i - 1], self.levels[i], *self._buffers[i])
+        return self.levels[depth]
+
+class GridStore(object):
+    """This class is an append-only store of per-frame tile grids for when
+    the number of frames isn't known in advance.
+
+    Capacity doubles whenever it runs out. Grids are kept in memory, or in a
+    raw file at path which is memory-mapped so that long recordings don't
+    have to fit in RAM.
+    """
+    def __init__(self, shape, dtype=np.float32, path=None, capacity=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.count = 0
+        self.data = None
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        if self.path is None:
+            data = np.empty((capacity,) + self.shape, dtype=self.dtype)
+            if self.data is not None:
+                data[:self.count] = self.data[:self.count]
+        else:
+            # Extend the file and map it again. Existing grids stay put.
+            if self.data is not None:
+                self.data.flush()
+            itemsize = self.dtype.itemsize * int(np.prod(self.shape))
+            with open(self.path, 'wb' if self.data is None else 'r+b') as f:
+                f.truncate(capacity * itemsize)
+            data = np.memmap(
+                    self.path, dtype=self.dtype, mode='r+',
+                    shape=(capacity,) + self.shape)
+        self.data = data
+
+    def append(self, grid):
+        """Add the next frame's grid."""
+        if self.count == len(self.data):
+            self._grow(2 * len(self.data))
+        self.data[self.count] = grid
+        self.count += 1
+
+    def array(self):
+        """Return a (frames, rows, cols) view of the grids stored so far."""
+        return self.data[:self.count]
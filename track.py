@@ -0,0 +1,201 @@
+"""track.py
+
+Keep a sample in focus on a live stream, rather than rerunning autofocus.py
+whenever it drifts.
+
+A Tracker records continuously into a Sweeper but only asks it for a focus
+measure at the current angle every interval seconds, so the processors are
+idle almost all of the time. Only when the measure has dropped by more than
+drop from its reference does the tracker dither: it measures step degrees
+either side of the current angle and climbs towards whichever is better,
+until the current angle is the best of the three. The servo therefore makes a
+few small moves when the sample drifts instead of a full sweep, and the
+camera never stops recording.
+
+Usage:
+
+    python track.py --angle 80
+    python track.py --sample slide3 --interval 2 --drop 0.15
+"""
+
+from __future__ import print_function
+import time
+import argparse
+
+import sweep
+import metrics
+import focus_cache
+
+
+class Tracker(object):
+    """This class tracks the focus of a sample by dithering the servo about
+    its current angle whenever the focus measure drops.
+
+    log records (time, angle, focus measure, action) for every check, where
+    action is 'hold' or 'refocus'. Remaining keyword arguments are passed on
+    to Sweeper.
+    """
+    def __init__(self, camera, resolution, angle, angles=range(1, 159),
+            step=2, drop=0.1, interval=1.0, max_climb=8, framerate=30,
+            **kwargs):
+        self.camera = camera
+        self.framerate = framerate
+        self.angles = angles
+        self.angle = angle
+        self.step = step
+        self.drop = drop
+        self.interval = interval
+        self.max_climb = max_climb
+        self.log = []
+
+        # Move into position while the camera calibrates, once.
+        previous = sweep.origin(angle)
+        sweep.move(angle)
+        sweep.calibrate(camera, resolution)
+        camera.framerate = framerate
+        self.sweeper = sweep.Sweeper(
+                [angle], resolution, start=previous, **kwargs)
+        self.sweeper.moves = 1
+        camera.start_recording(self.sweeper, 'yuv')
+        self.reference = self._wait()[0]
+
+    def _wait(self):
+        """Wait for the sweeper to finish and return its focus measures."""
+        start = time.time()
+        while time.time() - start < sweep.timeout and not (
+                self.sweeper.done and self.sweeper.idle()):
+            self.camera.wait_recording(1.0 / self.framerate)
+        if self.sweeper.failed:
+            sweep.servo.wait() # raises the error the move failed with
+        return [
+                -float('inf') if fm is None else fm
+                for fm in self.sweeper.focus_measures]
+
+    def measure(self, angles, hold=False):
+        """Sweep through angles on the live stream and return their focus
+        measures. With hold=True the servo is already at angles[0] and isn't
+        moved there again.
+        """
+        self.sweeper.reset(list(angles), hold=hold)
+        return self._wait()
+
+    def dither(self):
+        """Climb to the best angle nearby, measuring step degrees either side
+        of the current angle each time, and return its focus measure.
+        """
+        for _ in range(self.max_climb):
+            candidates = [
+                    a for a in (
+                        self.angle - self.step, self.angle,
+                        self.angle + self.step)
+                    if a in self.angles]
+            fms = self.measure(candidates)
+            best = fms.index(max(fms))
+            if candidates[best] == self.angle:
+                break
+            self.angle = candidates[best]
+
+        # Return to the best angle, which the sweep has moved on from.
+        sweep.move(self.angle)
+        return fms[best]
+
+    def check(self):
+        """Measure focus at the current angle and dither if it has dropped.
+        Return the action taken.
+        """
+        # The servo was left at the current angle, so measure without
+        # writing a move.
+        fm = self.measure([self.angle], hold=True)[0]
+        action = 'hold'
+        if fm < self.reference * (1 - self.drop):
+            # The reference follows the sample, so that a change in what is
+            # being looked at doesn't cause endless dithering.
+            fm = self.reference = self.dither()
+            action = 'refocus'
+        elif fm > self.reference:
+            self.reference = fm
+        self.log.append((time.time(), self.angle, fm, action))
+        return action
+
+    def run(self, duration=None):
+        """Check focus every interval seconds for duration seconds, or until
+        interrupted.
+        """
+        start = time.time()
+        while duration is None or time.time() - start < duration:
+            next_check = time.time() + self.interval
+            if self.check() == 'refocus':
+                print('refocused at %d degrees' % self.angle)
+            while time.time() < next_check:
+                self.camera.wait_recording(
+                        min(1.0, next_check - time.time()))
+
+    def close(self):
+        """Stop recording."""
+        self.camera.stop_recording()
+        self.camera.stop_preview()
+
+def main():
+    import picamera
+
+    parser = argparse.ArgumentParser(
+            description='Keep a sample in focus by dithering the servo '
+            'whenever the focus measure drops.')
+    parser.add_argument(
+            '--angle', type=int,
+            help='angle to start tracking from (default: the cached angle '
+            'for --sample)')
+    parser.add_argument(
+            '--sample',
+            help='ID of the sample in the focus cache. Its cached angle is '
+            'the starting point and the angle is stored on exit')
+    parser.add_argument(
+            '--cache', default=focus_cache.path,
+            help='focus cache file (default: %(default)s)')
+    parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='seconds between focus checks (default: 1)')
+    parser.add_argument(
+            '--drop', type=float, default=0.1,
+            help='fraction the focus measure must drop by to trigger '
+            'refocusing (default: 0.1)')
+    parser.add_argument(
+            '--step', type=int, default=2,
+            help='degrees to dither by (default: 2)')
+    parser.add_argument(
+            '--duration', type=float,
+            help='seconds to track for (default: until interrupted)')
+    parser.add_argument(
+            '--metric', choices=sorted(metrics.measures), default='laplace',
+            help='focus measure to track (default: laplace)')
+    args = parser.parse_args()
+
+    resolution = (640, 480)
+    cache = None
+    angle = args.angle
+    if args.sample is not None:
+        cache = focus_cache.FocusCache(args.cache)
+        cached = cache.get(args.sample, resolution)
+        if angle is None and cached is not None:
+            angle = cached['angle']
+    if angle is None:
+        parser.error('give --angle, or a --sample with a cached angle')
+
+    with picamera.PiCamera() as camera:
+        tracker = Tracker(
+                camera, resolution, angle, step=args.step, drop=args.drop,
+                interval=args.interval, metric=args.metric)
+        try:
+            tracker.run(args.duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            tracker.close()
+    refocused = len([e for e in tracker.log if e[3] == 'refocus'])
+    print('tracked for %d checks, refocusing %d times, ending at %d '
+            'degrees' % (len(tracker.log), refocused, tracker.angle))
+    if cache is not None:
+        cache.put(args.sample, tracker.angle, resolution)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import time
+import json
 import math
 
 import picamera
@@ -6,6 +7,7 @@ import picamera
 import sweep
 
 angles = range(6, 177, 5)
+framerate = 40
 
 sweep.move(angles[0])
 
@@ -21,9 +23,23 @@ with picamera.PiCamera() as camera:
     g = camera.awb_gains
     camera.awb_mode = 'off'
     camera.awb_gains = g
-    camera.framerate = 40
+    camera.framerate = framerate
     camera.start_recording('sweep.h264')
+
+    # Note when each move was commanded, relative to the start of the
+    # recording, so that replay.py can tell which angle each frame is at.
+    start = time.time()
+    moves = []
     for angle in angles:
+        moves.append((time.time() - start, angle))
         sweep.move(angle)
         camera.wait_recording(0.1)
     camera.stop_recording()
+
+    # Write the schedule while the camera is still open to read its
+    # resolution from.
+    with open('sweep.json', 'w') as f:
+        json.dump({
+            'framerate': framerate,
+            'resolution': list(camera.resolution),
+            'moves': moves}, f)